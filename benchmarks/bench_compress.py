@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Compares writing, appending and reading uncompressed, gzip and zstd compressed
+CSV and JSON files, reporting bytes written along with times.
+
+Usage: bench_compress.py [<ticks>] [--dir=<dir>] [--appends=<n>]
+
+Options:
+  --dir=<dir>      Directory to create test files in [default: .].
+  --appends=<n>    Append a day of ticks this many times [default: 10].
+"""
+import sys
+import os
+import os.path
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import six_scraper as script  # noqa: E402
+
+from bench_formats import make_data, measure
+
+
+def main():
+    args = docopt(__doc__)
+    n = int(args['<ticks>'] or 1000000)
+    appends = int(args['--appends'])
+    data = make_data(n)
+    # Each append adds a day of ticks on top of the same ones
+    days = [script.MarketData.from_columns(data.symbol, data.isin,
+                                           script.array('q', (t + i * script.DAY for t in data.times)),
+                                           data.prices, data.volumes)
+            for i in range(1, appends + 1)]
+
+    compressions = [None, 'gz'] + (['zst'] if script.zstandard else [])
+    print('%d ticks, %d appends of them' % (n, appends))
+    print('%-10s %10s %8s %10s %10s %10s' % ('file', 'size, MB', 'ratio', 'write', 'append', 'read'))
+
+    for format in ['csv', 'json']:
+        plain_size = None
+        for compression in compressions:
+            name = 'bench_compress.' + format + ('.' + compression if compression else '')
+            filename = os.path.join(args['--dir'], name)
+            try:
+                _, write_time = measure(lambda: script.save_data(data, format=format, mode='overwrite',
+                                                                 filename=filename))
+                size = os.path.getsize(filename)
+                plain_size = plain_size or size
+
+                _, append_time = measure(lambda: [script.save_data(day, format=format, mode='append',
+                                                                   filename=filename) for day in days])
+                loaded, read_time = measure(lambda: script._read_data(filename))
+                assert len(loaded) == n * (appends + 1)
+                print('%-10s %10.1f %7.1fx %9.3fs %9.3fs %9.3fs' % (
+                    format + ('.' + compression if compression else ''), size / 2 ** 20,
+                    plain_size / size, write_time, append_time / appends, read_time))
+            finally:
+                os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
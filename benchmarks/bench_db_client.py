@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Compares database access of update with a client per call against a shared client.
+Needs MongoDB server running, uses a scratch database.
+
+Usage: bench_db_client.py [<stocks>]
+"""
+import sys
+import os
+import os.path
+import time
+import datetime
+
+import pymongo
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['SIX_SCRAPER_DB'] = 'bench_smi'
+import six_scraper as script  # noqa: E402
+
+
+def per_call_db():
+    # The way _get_db() used to work
+    return pymongo.MongoClient()[os.environ['SIX_SCRAPER_DB']]
+
+
+def make_data(symbol, n=100):
+    start = datetime.datetime(2014, 7, 29, 9)
+    return script.MarketData(symbol, 'CH' + symbol, [
+        (start + datetime.timedelta(seconds=i), 20 + i / 100, i) for i in range(n)
+    ])
+
+
+def run(get_db, stocks):
+    real = script._get_db
+    script._get_db = get_db
+    try:
+        for data in stocks:
+            # What a single stock update does with database
+            script.find_stock(data.symbol)
+            script.save_data_to_db(data)
+    finally:
+        script._get_db = real
+
+
+def connections_created(client):
+    return client.admin.command('serverStatus')['connections']['totalCreated']
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    stocks = [make_data('S%03d' % i) for i in range(n)]
+    admin = pymongo.MongoClient()
+
+    for name, get_db in [('client per call', per_call_db), ('shared client', script._get_db)]:
+        admin.drop_database(os.environ['SIX_SCRAPER_DB'])
+        created = connections_created(admin)
+        start = time.perf_counter()
+        run(get_db, stocks)
+        elapsed = time.perf_counter() - start
+        print('%-16s %8.3fs %6d connections' % (name, elapsed, connections_created(admin) - created))
+
+    admin.drop_database(os.environ['SIX_SCRAPER_DB'])
+
+
+if __name__ == '__main__':
+    main()
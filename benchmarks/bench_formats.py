@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Compares writing and reading ticks in CSV, JSON and binary formats.
+
+Usage: bench_formats.py [<ticks>] [--dir=<dir>]
+
+Options:
+  --dir=<dir>  Directory to create test files in [default: .].
+"""
+import sys
+import os
+import os.path
+import time
+import datetime
+import random
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import six_scraper as script  # noqa: E402
+
+
+def make_data(n):
+    start = datetime.datetime(2014, 7, 29, 9)
+    return script.MarketData('ABBN', 'CH0012221716', (
+        (start + datetime.timedelta(seconds=i // 3), round(random.uniform(20, 22), 2), random.randint(1, 10000))
+        for i in range(n)
+    ))
+
+
+def measure(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def read(filename, format):
+    # Same as load_data(), but without looking up stock in database
+    read, file_mode = READERS[format]
+    with open(filename, file_mode) as f:
+        return read(f)
+
+
+READERS = {
+    'csv': (script._read_csv, 'r'),
+    'json': (script._read_json, 'r'),
+    'bin': (script._read_binary, 'rb'),
+}
+
+
+def main():
+    args = docopt(__doc__)
+    n = int(args['<ticks>'] or 1000000)
+    data = make_data(n)
+    print('%d ticks' % n)
+    print('%-6s %10s %10s %10s' % ('format', 'size, MB', 'write', 'read'))
+
+    for format in ['csv', 'json', 'bin']:
+        filename = os.path.join(args['--dir'], 'bench_formats.' + format)
+        try:
+            _, write_time = measure(lambda: script.save_data(data, format=format, mode='overwrite',
+                                                             filename=filename))
+            loaded, read_time = measure(lambda: read(filename, format))
+            assert len(loaded) == n
+            print('%-6s %10.1f %9.3fs %9.3fs' % (format, os.path.getsize(filename) / 2 ** 20,
+                                                  write_time, read_time))
+        finally:
+            os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
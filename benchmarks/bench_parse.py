@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Compares tick parsing with fast path parser against plain strptime().
+
+Usage: bench_parse.py [<ticks>]
+"""
+import sys
+import os.path
+import time
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import six_scraper as script  # noqa: E402
+
+from synthetic import make_raw
+
+
+def strptime_parse_raw(raw_data):
+    # The way _parse_raw() used to work
+    parsed = list(script.csv.reader(script.io.StringIO(raw_data), delimiter=';'))
+    date_str = parsed[1][0].strip()
+    return list(reversed([
+        (datetime.datetime.strptime(date_str + ' ' + t.strip(), '%d.%m.%Y %H:%M:%S'),
+         float(price), int(volume))
+        for t, price, volume, *_ in parsed[3:-1]
+    ]))
+
+
+def strptime_from_rows(rows):
+    return [(datetime.datetime.strptime(dt, '%d.%m.%Y %H:%M:%S'), float(price), int(volume))
+            for dt, price, volume in rows]
+
+
+def measure(name, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    print('%-28s %8.3fs' % (name, elapsed))
+    return result, elapsed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    raw = make_raw(n)
+    print('%d ticks, %.1f MB' % (n, len(raw) / 2 ** 20))
+
+    old, old_time = measure('_parse_raw, strptime', strptime_parse_raw, raw)
+    (_, _, new), new_time = measure('_parse_raw, fast path', script._parse_raw, raw)
+    assert old == new
+    print('speed-up %.1fx' % (old_time / new_time))
+
+    # Polling a liquid stock, most of the day is already stored
+    since = new[len(new) * 95 // 100][0]
+    (_, _, tail), tail_time = measure('_parse_raw, since 95%', script._parse_raw, raw, since)
+    assert tail == [tick for tick in new if tick[0] >= since]
+    print('speed-up %.1fx' % (new_time / tail_time))
+
+    rows = [(script.str_datetime(dt), price, volume) for dt, price, volume in new]
+    old, old_time = measure('from_rows, strptime', strptime_from_rows, rows)
+    new, new_time = measure('from_rows, fast path', script.MarketData.from_rows, None, None, rows)
+    assert old == new.data
+    print('speed-up %.1fx' % (old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Measures time to find last tick of CSV file for grab --csv --append,
+comparing tail seeking _peek_csv() with reading whole file.
+
+Usage: bench_peek_csv.py [--dir=<dir>] [--sizes=<sizes>] [--full-max=<mb>]
+
+Options:
+  --dir=<dir>       Directory to create test files in [default: .].
+  --sizes=<sizes>   Comma separated file sizes in megabytes [default: 1,10,100,1000,5000].
+  --full-max=<mb>   Largest file to read in full, it takes time and memory [default: 1000].
+"""
+import sys
+import os
+import os.path
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import six_scraper as script  # noqa: E402
+
+
+LINE = b'29.07.2014 15:24:35;21.6;9010\r\n'
+BLOCK = LINE * (2 ** 20 // len(LINE))
+
+
+def make_file(filename, size):
+    with open(filename, 'wb') as f:
+        written = 0
+        while written < size:
+            written += f.write(BLOCK)
+
+
+def read_full(f):
+    # The way _peek_csv() used to work
+    lines = f.readlines()
+    return script.parse_datetime(lines[-1].decode().split(';')[0])
+
+
+def measure(func, filename):
+    with open(filename, 'rb') as f:
+        start = time.perf_counter()
+        func(f)
+        return time.perf_counter() - start
+
+
+def main():
+    args = docopt(__doc__)
+    sizes = [int(mb) for mb in args['--sizes'].split(',')]
+    full_max = int(args['--full-max'])
+    filename = os.path.join(args['--dir'], 'bench_peek.csv')
+
+    print('%10s %12s %12s' % ('size, MB', 'tail seek', 'read all'))
+    try:
+        for mb in sizes:
+            make_file(filename, mb * 2 ** 20)
+            tail = measure(script._peek_csv, filename)
+            full = '%11.4fs' % measure(read_full, filename) if mb <= full_max else '%12s' % '-'
+            print('%10d %11.6fs %s' % (mb, tail, full))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Measures startup of six-scraper with -X importtime, failing if imports
+take longer than budget. list is run against unreachable database,
+so that only startup and connecting are measured.
+
+Usage: bench_startup.py [--runs=<n>] [--help-budget=<ms>] [--list-budget=<ms>] [--top=<n>]
+
+Options:
+  --runs=<n>            Take best of n runs [default: 5].
+  --help-budget=<ms>    Import time budget for --help [default: 150].
+  --list-budget=<ms>    Import time budget for list [default: 350].
+  --top=<n>             Show n slowest top level imports [default: 5].
+"""
+import sys
+import os
+import os.path
+import time
+import subprocess
+
+from docopt import docopt
+
+
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'six_scraper.py')
+ENV = dict(os.environ,
+           SIX_SCRAPER_MONGO_URI='mongodb://127.0.0.1:1',
+           SIX_SCRAPER_MONGO_TIMEOUT='0.1')
+
+
+def measure(args):
+    """
+    Returns wall time, total import time and top level imports with their cumulative times,
+    all in milliseconds.
+    """
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', SCRIPT] + args, env=ENV,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = (time.perf_counter() - start) * 1000
+
+    total, top = 0, {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        total += int(self_us)
+        if not name.startswith('  '):
+            top[name.strip()] = int(cumulative_us) / 1000
+    return wall, total / 1000, top
+
+
+def bench(name, args, runs, budget, top_n):
+    wall, total, top = min((measure(args) for _ in range(runs)), key=lambda r: r[1])
+    ok = total <= budget
+    print('%-8s imports %6.1f ms (budget %d ms), wall %6.1f ms  %s'
+          % (name, total, budget, wall, 'OK' if ok else 'OVER BUDGET'))
+    for module, ms in sorted(top.items(), key=lambda item: -item[1])[:top_n]:
+        print('    %-30s %6.1f ms' % (module, ms))
+    return ok
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    runs, top_n = int(args['--runs']), int(args['--top'])
+    results = [
+        bench('--help', ['--help'], runs, int(args['--help-budget']), top_n),
+        bench('list', ['list'], runs, int(args['--list-budget']), top_n),
+    ]
+    sys.exit(0 if all(results) else 1)
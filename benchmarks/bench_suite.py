@@ -0,0 +1,205 @@
+"""
+Benchmarks of grab, update, export and load against a local imitation of SIX
+and MongoDB. Database benchmarks are skipped if there is no server, as mongomock
+checks unique index on every insert and would never finish. Needs pytest-benchmark.
+
+Run with:
+
+    py.test benchmarks/bench_suite.py --benchmark-autosave
+"""
+import sys
+import os
+import os.path
+import time
+import datetime
+import tracemalloc
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+import pymongo
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['SIX_SCRAPER_DB'] = 'bench_smi'
+import six_scraper as script  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(__file__))
+from synthetic import make_raw, make_stocks
+
+
+TICKS = int(os.environ.get('BENCH_TICKS', 100000))
+STOCKS = int(os.environ.get('BENCH_STOCKS', 10))
+LATENCY = float(os.environ.get('BENCH_LATENCY', 0.02))
+
+
+# Local SIX
+
+class SixHandler(BaseHTTPRequestHandler):
+    """
+    Serves info_market_data_download.csv like SIX does, redirecting unknown ids
+    to not_found page and honoring If-None-Match.
+    """
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        url = urlsplit(self.path)
+        if url.path == '/not_found':
+            return self._respond(200, b'Security not found')
+
+        symbol = parse_qs(url.query).get('id', [None])[0]
+        if symbol not in self.server.payloads:
+            return self._respond(302, headers={'Location': '/not_found'})
+
+        body, etag = self.server.payloads[symbol]
+        if self.headers.get('If-None-Match') == etag:
+            return self._respond(304, headers={'ETag': etag})
+        self._respond(200, body, headers={'ETag': etag})
+
+    def _respond(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def six():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SixHandler)
+    server.daemon_threads = True
+    server.latency = LATENCY
+    server.payloads = {}
+    for symbol, isin in make_stocks(STOCKS):
+        raw = make_raw(TICKS, symbol, isin, seed=symbol)
+        server.payloads[symbol] = raw.encode('utf-8'), '"%s"' % symbol
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    real = script.SIX_URL
+    script.SIX_URL = 'http://127.0.0.1:%d/shares/info_market_data_download.csv' % server.server_port
+    yield server
+    script.SIX_URL = real
+    server.shutdown()
+
+
+# Database
+
+@pytest.fixture(scope='module')
+def db():
+    client = pymongo.MongoClient(os.environ.get('SIX_SCRAPER_MONGO_URI'), serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command('ping')
+    except pymongo.errors.ServerSelectionTimeoutError:
+        pytest.skip("No MongoDB server to benchmark against")
+
+    real = script._client
+    script._client = client
+    db = script._get_db()
+    yield db
+    client.drop_database(db.name)
+    script._client = real
+
+
+def reset(db, stocks=()):
+    db.client.drop_database(db.name)
+    script._get_resolver().invalidate()
+    script._get_store().setup()
+    if stocks:
+        db.stocks.insert_many([{'symbol': symbol, 'isin': isin} for symbol, isin in stocks])
+
+
+@pytest.fixture(scope='module')
+def stored(db, six):
+    """Database with all stocks updated."""
+    stocks = make_stocks(STOCKS)
+    reset(db, stocks)
+    script.do_update([symbol for symbol, _ in stocks])
+    return stocks
+
+
+# Utilities
+
+def run(benchmark, func, *args, setup=None, rounds=3):
+    """
+    Benchmarks func, recording peak memory of an extra untimed run.
+    """
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        func(*args)
+    finally:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    benchmark.extra_info['peak_memory_mb'] = round(peak / 2 ** 20, 1)
+    benchmark.extra_info['ticks'] = TICKS
+    return benchmark.pedantic(func, args, setup=setup, rounds=rounds)
+
+
+# Benchmarks
+
+def test_parse(benchmark):
+    raw = make_raw(TICKS)
+    run(benchmark, script._parse_raw, raw, rounds=5)
+
+
+def test_parse_since(benchmark):
+    raw = make_raw(TICKS)
+    since = datetime.datetime(2014, 7, 29, 17, 25)
+    run(benchmark, script._parse_raw, raw, since, rounds=5)
+
+
+def test_grab(benchmark, six):
+    run(benchmark, script.grab, 'S000')
+
+
+def test_grab_not_found(benchmark, six):
+    def grab_missing():
+        with pytest.raises(SystemExit):
+            script.grab('NOPE')
+    run(benchmark, grab_missing)
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_update(benchmark, db, six, capsys, workers):
+    stocks = make_stocks(STOCKS)
+    run(benchmark, script.do_update, [symbol for symbol, _ in stocks], workers,
+        setup=lambda: reset(db, stocks))
+
+
+def test_update_not_modified(benchmark, db, stored, capsys):
+    run(benchmark, script.do_update, [symbol for symbol, _ in stored])
+
+
+def test_update_modified(benchmark, db, stored, capsys):
+    # Nothing is new, but validators are lost, so whole day is downloaded
+    def forget_validators():
+        db.http_cache.delete_many({})
+    run(benchmark, script.do_update, [symbol for symbol, _ in stored], setup=forget_validators)
+
+
+@pytest.mark.parametrize('format', ['csv', 'json', 'bin'])
+def test_export(benchmark, db, stored, tmpdir, format):
+    symbols = [symbol for symbol, _ in stored]
+    options = {'format': format, 'mode': 'overwrite', 'filename': None}
+    with tmpdir.as_cwd():
+        run(benchmark, script.do_export, symbols, None, None, 1, False, None, False, options)
+
+
+@pytest.mark.parametrize('format', ['csv', 'json', 'bin'])
+def test_load(benchmark, db, stored, tmpdir, capsys, format):
+    symbols = [symbol for symbol, _ in stored]
+    with tmpdir.as_cwd():
+        script.do_export(symbols, options={'format': format, 'mode': 'overwrite', 'filename': None})
+        run(benchmark, script.do_load, ['.'], None, 1, script.INSERT_BATCH_SIZE, {'format': format},
+            setup=lambda: reset(db, stored))
+
+
+def test_stats(benchmark, db, stored, tmpdir):
+    options = {'format': 'csv', 'mode': 'overwrite', 'filename': None}
+    with tmpdir.as_cwd():
+        run(benchmark, script.do_stats, None, None, None, 'hour', options)
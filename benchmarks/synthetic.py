@@ -0,0 +1,28 @@
+"""
+Synthetic SIX downloads for benchmarks.
+"""
+import random
+import datetime
+
+
+def make_raw(n, symbol='ABBN', isin='CH0012221716', date=datetime.date(2014, 7, 29), seed=None):
+    """
+    Makes n ticks of a trading day in SIX CSV format, newest first,
+    several trades could share the same second.
+    """
+    rand = random.Random(seed)
+    lines = ['%s LTD N (%s/%s)' % (symbol, symbol, isin), '%s;' % date.strftime('%d.%m.%Y'),
+             'Time;Price;Volume;']
+    seconds = 17 * 3600 + 30 * 60
+    price = rand.uniform(20, 200)
+    for _ in range(n):
+        seconds = max(seconds - rand.randint(0, 1), 9 * 3600)
+        price = round(max(price + rand.gauss(0, 0.02), 0.01), 2)
+        t = '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+        lines.append('%s;%.2f;%d;' % (t, price, rand.randint(1, 10000)))
+    return '\n'.join(lines) + '\n\n'
+
+
+def make_stocks(n):
+    """Returns n (symbol, isin) pairs."""
+    return [('S%03d' % i, 'CH%010d' % i) for i in range(n)]
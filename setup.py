@@ -0,0 +1,21 @@
+from setuptools import setup
+
+
+with open('requirements.txt') as f:
+    requirements = f.read().split()
+
+
+setup(
+    name='six-scraper',
+    version='0.1',
+    description='A command line tool to scrape, store and manage stock data from six-swiss-exchange.com',
+    py_modules=['six_scraper'],
+    install_requires=requirements,
+    extras_require={
+        'zstd': ['zstandard'],
+    },
+    python_requires='>=3.9',
+    entry_points={
+        'console_scripts': ['six-scraper = six_scraper:run'],
+    },
+)
@@ -0,0 +1,2997 @@
+#!/usr/bin/env python3
+"""SIX Scraper CLI.
+
+Usage:
+  six-scraper list
+  six-scraper add <symbol-or-isin>...
+  six-scraper remove <symbol-or-isin>...
+  six-scraper purge <symbol-or-isin>...
+  six-scraper update [<symbol-or-isin>...] [--workers=<n>] [--rate=<r>] [--max-inflight=<n>]
+                        [--batch-size=<n>] [--metrics] [--prometheus=<file>] [--profile=<file>]
+  six-scraper watch [<symbol-or-isin>...] [--interval=<s>] [--max-interval=<s>] [--workers=<n>]
+                       [--rate=<r>] [--max-inflight=<n>] [--batch-size=<n>]
+                       [--metrics] [--prometheus=<file>] [--profile=<file>]
+  six-scraper grab <symbol-or-isin>... (--csv | --json | --binary) [-f <file>] [options]
+                      [--metrics] [--prometheus=<file>] [--profile=<file>]
+  six-scraper export <symbol-or-isin>... (--csv | --json | --binary) [-f <file>] [--workers=<n>] [options]
+                        [--metrics] [--prometheus=<file>] [--profile=<file>]
+  six-scraper load (-f <file> | <path>...) [--csv | --json | --binary] [--as=<symbol-or-isin>]
+                      [--workers=<n>] [--batch-size=<n>] [--metrics] [--prometheus=<file>] [--profile=<file>]
+  six-scraper convert -f <file>
+  six-scraper setup
+  six-scraper migrate <storage>
+  six-scraper stats [<symbol-or-isin>...] (--csv | --json) [-f <file>] [--by=<period>] [options]
+                     [--metrics] [--prometheus=<file>] [--profile=<file>]
+  six-scraper rebuild-rollups [<symbol-or-isin>...]
+  six-scraper verify [<symbol-or-isin>...] [--deep] [--repair]
+
+Options:
+  -h --help      Show this screen.
+  --csv          Output CSV.
+  --json         Output JSON.
+  --binary       Output binary columns, which could be memory-mapped.
+  -a --append    Append data to target file if exists.
+  --overwrite    Overwrite target file if exists.
+  -f <file>      Use named file, defaults to <symbol>.csv, <symbol>.json or <symbol>.bin.
+                 Use "-f -" to write to STDOUT.
+  --from=<from>  Start range from this datetime.
+  --to=<to>      End range with this datetime.
+  --compress=<codec>
+                 Compress output with gz or zst, also chosen by file extension
+                 like .csv.gz or .json.zst.
+  --combined     Export all stocks into a single file with symbol column,
+                 defaults to export.csv or export.json.
+  --resample=<interval>
+                 Export OHLCV bars with VWAP and trade count instead of ticks,
+                 interval is like 1min, 5min, 1h or 1d.
+  --rollups      Read resampled bars from minute and daily rollups kept
+                 in database instead of aggregating ticks.
+  --by=<period>  Compute stats by day or hour [default: day].
+  --as=<symbol-or-isin>
+                 Load all files as this stock instead of guessing it by file name.
+  --workers=<n>  Process this many stocks or files concurrently [default: 1].
+  --rate=<r>     Limit requests to six-swiss-exchange.com per second.
+  --max-inflight=<n>
+                 Limit number of simultaneous requests to six-swiss-exchange.com.
+  --batch-size=<n>
+                 Insert ticks into database in batches of this size [default: 10000].
+  --interval=<s>
+                 Poll each stock at least this often, in seconds [default: 60].
+  --max-interval=<s>
+                 Poll stocks not getting new ticks this rarely, in seconds [default: 900].
+  --metrics      Print phase timings and counters to stderr when done.
+  --prometheus=<file>
+                 Write metrics to file in Prometheus text format when done,
+                 e.g. for node-exporter textfile collector.
+  --profile=<file>
+                 Write cProfile stats of the main thread to file.
+  --deep         Verify digests against stored ticks instead of daily rollups.
+  --repair       Store digests recomputed from ticks by --deep verification.
+
+Datetimes could be specified in any of the following formats:
+
+    %d.%m.%Y
+    %d.%m.%Y %H:%M
+    %d.%m.%Y %H:%M:%S
+    %d.%m.%YT%H:%M
+    %d.%m.%YT%H:%M:%S
+
+"""
+
+import sys
+import os
+import os.path
+import io
+import time
+import random
+import datetime
+import math
+import csv
+import gzip
+import zlib
+import glob
+import hashlib
+import json
+import threading
+import queue
+import atexit
+import mmap
+import struct
+import signal
+import socket
+import importlib.util
+from operator import itemgetter
+from itertools import groupby
+from collections import deque
+from contextlib import suppress, contextmanager
+from functools import lru_cache, partial
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from zoneinfo import ZoneInfo
+
+from funcy import re_find, chunks, group_by, pluck, cat, lremove, some, silent, first
+from docopt import docopt
+
+
+def _lazy_import(name):
+    """
+    Returns module, which is actually imported on first attribute access,
+    so that commands not using it don't pay for importing it.
+
+    NOTE: loading lazy module is not thread-safe, so first access should be made
+          by a single thread, e.g. under a lock as in _get_session() and _get_client().
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named %r" % name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# These take more time to import than everything else together
+requests = _lazy_import('requests')
+pymongo = _lazy_import('pymongo')
+
+# Optional, makes stats faster
+try:
+    np = _lazy_import('numpy')
+except ImportError:
+    np = None
+
+# Optional, needed for *.zst files
+try:
+    zstandard = _lazy_import('zstandard')
+except ImportError:
+    zstandard = None
+
+
+# Business logic abstractions
+
+EPOCH = datetime.datetime(1970, 1, 1)
+SECOND = datetime.timedelta(seconds=1)
+
+class MarketData:
+    """
+    A class encapsulating stock data range.
+
+    Ticks are stored column wise: epoch seconds, prices and volumes.
+    Iterating over it yields (datetime, price, volume) tuples.
+    """
+    __slots__ = ('symbol', 'isin', 'times', 'prices', 'volumes')
+    json_key = 'ticks'
+
+    def __reduce__(self):
+        # Columns could be memoryviews of a mapped file, which are not picklable
+        columns = (array(typecode, column) for column, typecode
+                   in [(self.times, 'q'), (self.prices, 'd'), (self.volumes, 'q')])
+        return self.from_columns, (self.symbol, self.isin, *columns)
+
+    def __init__(self, symbol, isin, data=()):
+        self.symbol = symbol
+        self.isin = isin
+        self.times = array('q')
+        self.prices = array('d')
+        self.volumes = array('q')
+        self.extend(data)
+
+    @classmethod
+    def from_columns(cls, symbol, isin, times, prices, volumes):
+        data = cls(symbol, isin)
+        data.times, data.prices, data.volumes = times, prices, volumes
+        return data
+
+    @classmethod
+    def from_rows(cls, symbol, isin, rows):
+        """
+        Parses (time, price, volume) rows of a file, which could be in any time order.
+        """
+        data = cls(symbol, isin, (
+            (parse_datetime(dt), float(price), int(volume))
+            for dt, price, volume in rows
+        ))
+        times = data.times
+        if any(times[i] > times[i + 1] for i in range(len(times) - 1)):
+            # Stable, so trades within the same second keep their order
+            order = sorted(range(len(times)), key=times.__getitem__)
+            data = cls.from_columns(symbol, isin, *(array(column.typecode, map(column.__getitem__, order))
+                                                    for column in (data.times, data.prices, data.volumes)))
+        return data
+
+    @classmethod
+    def concat(cls, symbol, isin, parts):
+        """
+        Joins time ordered parts, copying columns as they are, even if memory-mapped.
+        """
+        data = cls(symbol, isin)
+        for part in parts:
+            for column, part_column in zip((data.times, data.prices, data.volumes),
+                                           (part.times, part.prices, part.volumes)):
+                column.frombytes(memoryview(part_column).cast('B'))
+        return data
+
+    def extend(self, ticks):
+        # NOTE: this fails for slices, they share memory with original data
+        times_append = self.times.append
+        prices_append = self.prices.append
+        volumes_append = self.volumes.append
+        for dt, price, volume in ticks:
+            times_append((dt - EPOCH) // SECOND)
+            prices_append(price)
+            volumes_append(volume)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        return zip(map(from_timestamp, self.times), self.prices, self.volumes)
+
+    @property
+    def data(self):
+        return list(self)
+
+    def slice(self, start=None, end=None):
+        """
+        Returns ticks from start to end inclusive, sharing memory with this object.
+        """
+        lo = bisect_left(self.times, to_timestamp(start)) if start is not None else 0
+        hi = bisect_right(self.times, to_timestamp(end)) if end is not None else len(self)
+        columns = (memoryview(column)[lo:hi] for column in (self.times, self.prices, self.volumes))
+        return self.from_columns(self.symbol, self.isin, *columns)
+
+    def encoded_rows(self, start=EPOCH):
+        for dt, price, volume in self.slice(start=start + SECOND):
+            yield str_datetime(dt), price, volume
+
+
+class TickStream:
+    """
+    Same as MarketData, but ticks are consumed lazily from an iterator.
+    Could be iterated only once.
+    """
+    __slots__ = ('symbol', 'isin', 'ticks')
+    json_key = 'ticks'
+
+    def __init__(self, symbol, isin, ticks):
+        self.symbol = symbol
+        self.isin = isin
+        self.ticks = ticks
+
+    def __iter__(self):
+        return iter(self.ticks)
+
+    def encoded_rows(self, start=EPOCH):
+        for dt, price, volume in self.ticks:
+            if dt > start:
+                yield str_datetime(dt), price, volume
+
+
+class CombinedTicks:
+    """
+    Ticks of several stocks in long format, (symbol, time, price, volume) tuples.
+    """
+    __slots__ = ('symbol', 'isin', 'ticks')
+    json_key = 'ticks'
+
+    def __init__(self, ticks):
+        self.symbol = self.isin = None
+        self.ticks = ticks
+
+    def __iter__(self):
+        return iter(self.ticks)
+
+    def encoded_rows(self, start=EPOCH):
+        for symbol, dt, price, volume in self.ticks:
+            if dt > start:
+                yield symbol, str_datetime(dt), price, volume
+
+
+class Bars:
+    """
+    OHLCV bars, iterating over it yields
+    (start time, open, high, low, close, volume, vwap, count) tuples.
+
+    Bars are built lazily from raw [start timestamp, open, high, low, close,
+    volume, turnover, count] lists, so they could be iterated only once.
+    """
+    __slots__ = ('symbol', 'isin', 'bars')
+    json_key = 'bars'
+
+    def __init__(self, symbol, isin, bars):
+        self.symbol = symbol
+        self.isin = isin
+        self.bars = bars
+
+    @classmethod
+    def from_ticks(cls, symbol, isin, ticks, seconds):
+        return cls(symbol, isin, _aggregate_ticks(ticks, seconds))
+
+    def __iter__(self):
+        return map(_finish_bar, self.bars)
+
+    def encoded_rows(self, start=EPOCH):
+        for bar in self:
+            if bar[0] > start:
+                yield (str_datetime(bar[0]),) + bar[1:]
+
+
+class Stats:
+    """
+    Per period stats of several stocks in long format,
+    (symbol, start time, count, volume, turnover, vwap, volatility) tuples.
+    """
+    __slots__ = ('symbol', 'isin', 'rows')
+    json_key = 'stats'
+
+    def __init__(self, rows):
+        self.symbol = self.isin = None
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def encoded_rows(self, start=EPOCH):
+        for symbol, dt, *values in self.rows:
+            if dt > start:
+                yield (symbol, str_datetime(dt), *values)
+
+
+def _aggregate_ticks(ticks, seconds):
+    """
+    Aggregates time ordered (datetime, price, volume) ticks into raw bars in a single pass.
+    """
+    bar = None
+    for dt, price, volume in ticks:
+        start = to_timestamp(dt) // seconds * seconds
+        if bar is None or start != bar[0]:
+            if bar:
+                yield bar
+            bar = [start, price, price, price, price, 0, 0.0, 0]
+        if price > bar[2]:
+            bar[2] = price
+        if price < bar[3]:
+            bar[3] = price
+        bar[4] = price
+        bar[5] += volume
+        bar[6] += price * volume
+        bar[7] += 1
+    if bar:
+        yield bar
+
+
+def _aggregate_bars(bars, seconds):
+    """
+    Aggregates time ordered raw bars into longer ones.
+    """
+    bar = None
+    for start, open_, high, low, close, volume, turnover, count in bars:
+        start = start // seconds * seconds
+        if bar is None or start != bar[0]:
+            if bar:
+                yield bar
+            bar = [start, open_, high, low, close, 0, 0.0, 0]
+        if high > bar[2]:
+            bar[2] = high
+        if low < bar[3]:
+            bar[3] = low
+        bar[4] = close
+        bar[5] += volume
+        bar[6] += turnover
+        bar[7] += count
+    if bar:
+        yield bar
+
+
+def _finish_bar(bar):
+    start, open_, high, low, close, volume, turnover, count = bar
+    vwap = round(turnover / volume, 6) if volume else close
+    return from_timestamp(start), open_, high, low, close, volume, vwap, count
+
+
+def tick_stats(data, seconds):
+    """
+    Yields (start time, count, volume, turnover, vwap, volatility) for each period of MarketData.
+    Volatility is a realized one: square root of sum of squared log returns
+    between consecutive ticks within period.
+    """
+    aggregate = _tick_stats_numpy if np is not None else _tick_stats
+    for start, count, volume, turnover, variance in aggregate(data, seconds):
+        vwap = round(turnover / volume, 6) if volume else None
+        yield from_timestamp(start), count, volume, round(turnover, 2), vwap, round(math.sqrt(variance), 8)
+
+
+def _tick_stats(data, seconds):
+    """
+    Yields raw (start timestamp, count, volume, turnover, variance) stats in a single pass over columns.
+    """
+    stats = last_log_price = None
+    log = math.log
+    for t, price, volume in zip(data.times, data.prices, data.volumes):
+        # Broken ticks with non-positive prices have no log returns, skip them altogether
+        if price <= 0:
+            continue
+        start = t // seconds * seconds
+        log_price = log(price)
+        if stats is None or start != stats[0]:
+            if stats:
+                yield tuple(stats)
+            stats = [start, 0, 0, 0.0, 0.0]
+        else:
+            stats[4] += (log_price - last_log_price) ** 2
+        last_log_price = log_price
+        stats[1] += 1
+        stats[2] += volume
+        stats[3] += price * volume
+    if stats:
+        yield tuple(stats)
+
+
+def _tick_stats_numpy(data, seconds):
+    """
+    Same as _tick_stats(), but with vectorized passes over columns, sharing their memory.
+    """
+    times = np.frombuffer(data.times, dtype='q')
+    prices = np.frombuffer(data.prices, dtype='d')
+    volumes = np.frombuffer(data.volumes, dtype='q')
+    valid = prices > 0
+    if not valid.all():
+        times, prices, volumes = times[valid], prices[valid], volumes[valid]
+    if not len(times):
+        return iter(())
+
+    starts = times // seconds * seconds
+    firsts = np.flatnonzero(np.concatenate(([True], starts[1:] != starts[:-1])))
+    squared_returns = np.empty(len(prices))
+    squared_returns[1:] = np.diff(np.log(prices)) ** 2
+    # Returns across period boundaries don't count
+    squared_returns[firsts] = 0.0
+
+    return zip(
+        starts[firsts].tolist(),
+        np.diff(np.append(firsts, len(times))).tolist(),
+        np.add.reduceat(volumes, firsts).tolist(),
+        np.add.reduceat(prices * volumes, firsts).tolist(),
+        np.add.reduceat(squared_returns, firsts).tolist(),
+    )
+
+
+def parse_interval(interval):
+    """
+    Parses bar interval like 1min, 5min, 1h or 1d into seconds.
+    """
+    UNITS = {'min': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+    number, unit = re_find(r'^(\d+)(min|h|d)$', interval) or (None, None)
+    if not number or not int(number):
+        raise ValueError("Interval %r does not match format like 1min, 5min, 1h or 1d" % interval)
+    return int(number) * UNITS[unit]
+
+
+def to_timestamp(dt):
+    return (dt - EPOCH) // SECOND
+
+def from_timestamp(ts):
+    return EPOCH + datetime.timedelta(seconds=ts)
+
+
+def parse_datetime(dt_str):
+    # Fast path for fixed width "dd.mm.YYYY HH:MM:SS", strptime() is way slower
+    if len(dt_str) == 19 and dt_str[10] == ' ':
+        try:
+            return datetime.datetime(*_parse_date(dt_str[:10]), *_parse_time(dt_str[11:]))
+        except ValueError:
+            pass
+    return datetime.datetime.strptime(dt_str, '%d.%m.%Y %H:%M:%S')
+
+@lru_cache(maxsize=1024)
+def _parse_date(d_str):
+    # Ticks come in runs of the same date, so this is mostly a cache hit
+    if len(d_str) != 10 or d_str[2] != '.' or d_str[5] != '.':
+        raise ValueError("Date %r does not match format '%%d.%%m.%%Y'" % d_str)
+    return int(d_str[6:]), int(d_str[3:5]), int(d_str[:2])
+
+def _parse_time(t_str):
+    if len(t_str) != 8 or t_str[2] != ':' or t_str[5] != ':':
+        raise ValueError("Time %r does not match format '%%H:%%M:%%S'" % t_str)
+    return int(t_str[:2]), int(t_str[3:5]), int(t_str[6:])
+
+def str_datetime(dt):
+    return dt.strftime('%d.%m.%Y %H:%M:%S')
+
+
+# Metrics
+
+class Metrics:
+    """
+    Collects phase timings and counters, optionally per symbol, shared between threads.
+    Timings are kept as Prometheus style histograms. If StatsD address is given,
+    each observation is sent there as well.
+    """
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, statsd=None):
+        self.timings = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._statsd = None
+        if statsd:
+            host, port = statsd.rsplit(':', 1)
+            self._statsd = (host, int(port)), socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.monotonic() - start)
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            timing = self.timings.setdefault(phase, {'buckets': [0] * len(self.BUCKETS),
+                                                     'count': 0, 'sum': 0.0, 'max': 0.0})
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    timing['buckets'][i] += 1
+            timing['count'] += 1
+            timing['sum'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+        self._send('%s:%d|ms' % (phase, seconds * 1000))
+
+    def count(self, name, value=1, symbol=None):
+        with self._lock:
+            self.counters[name, symbol] = self.counters.get((name, symbol), 0) + value
+        self._send('%s:%d|c' % (name, value))
+
+    def summary(self):
+        lines = ['%-12s %8s %10s %10s %10s' % ('Phase', 'Count', 'Total', 'Mean', 'Max')]
+        for phase, timing in sorted(self.timings.items()):
+            lines.append('%-12s %8d %9.3fs %9.3fs %9.3fs' % (
+                phase, timing['count'], timing['sum'], timing['sum'] / timing['count'], timing['max']))
+
+        names = sorted({name for name, _ in self.counters})
+        if names:
+            symbols = sorted({symbol for _, symbol in self.counters}, key=lambda symbol: symbol or '')
+            lines.append('')
+            lines.append(' '.join(['%-12s' % 'Symbol'] + ['%16s' % name for name in names]))
+            for symbol in symbols:
+                values = ['%16d' % self.counters.get((name, symbol), 0) for name in names]
+                lines.append(' '.join(['%-12s' % (symbol or '-')] + values))
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        lines = []
+        if self.timings:
+            lines.append('# TYPE six_scraper_phase_seconds histogram')
+        for phase, timing in sorted(self.timings.items()):
+            for bound, count in zip(self.BUCKETS, timing['buckets']):
+                lines.append('six_scraper_phase_seconds_bucket{phase="%s",le="%s"} %d' % (phase, bound, count))
+            lines.append('six_scraper_phase_seconds_bucket{phase="%s",le="+Inf"} %d' % (phase, timing['count']))
+            lines.append('six_scraper_phase_seconds_sum{phase="%s"} %f' % (phase, timing['sum']))
+            lines.append('six_scraper_phase_seconds_count{phase="%s"} %d' % (phase, timing['count']))
+
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append('# TYPE six_scraper_%s_total counter' % name)
+            for (counter, symbol), value in sorted(self.counters.items(), key=lambda item: str(item[0])):
+                if counter == name:
+                    labels = '{symbol="%s"}' % symbol if symbol else ''
+                    lines.append('six_scraper_%s_total%s %d' % (name, labels, value))
+
+        lines.append('# TYPE six_scraper_last_run_timestamp_seconds gauge')
+        lines.append('six_scraper_last_run_timestamp_seconds %d' % time.time())
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename):
+        # Textfile collector could read file while it's written, so replace it atomically
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp_filename, filename)
+
+    def _send(self, metric):
+        if self._statsd:
+            address, sock = self._statsd
+            with suppress(OSError):
+                sock.sendto(('six_scraper.' + metric).encode(), address)
+
+
+METRICS = Metrics(statsd=os.environ.get('SIX_SCRAPER_STATSD'))
+
+
+# Grab data from six-swiss-exchange.com
+
+class Throttle:
+    """
+    Limits request rate and number of requests in flight to a single host.
+    Shared between threads, use as a context manager around each request.
+    """
+    def __init__(self, rate=None, max_inflight=None):
+        self.interval = 1 / rate if rate else 0
+        self._slots = threading.BoundedSemaphore(max_inflight) if max_inflight else None
+        self._lock = threading.Lock()
+        self._next_time = 0
+
+    def __enter__(self):
+        if self._slots:
+            self._slots.acquire()
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+        return self
+
+    def __exit__(self, exctype, excinst, exctb):
+        if self._slots:
+            self._slots.release()
+
+
+# Unlimited by default, configured from command line options in main()
+SIX_THROTTLE = Throttle()
+
+
+SIX_URL = os.environ.get('SIX_SCRAPER_URL',
+                         'http://www.six-swiss-exchange.com/shares/info_market_data_download.csv')
+
+# (connect, read) timeouts in seconds
+HTTP_TIMEOUT = (
+    float(os.environ.get('SIX_SCRAPER_CONNECT_TIMEOUT', 5)),
+    float(os.environ.get('SIX_SCRAPER_READ_TIMEOUT', 30)),
+)
+HTTP_POOL_SIZE = int(os.environ.get('SIX_SCRAPER_HTTP_POOL_SIZE', 10))
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session():
+    """
+    Returns process wide HTTP session, so that all requests share
+    a pool of keep-alive connections.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+def _backoff(attempt, symbol=None):
+    METRICS.count('retries', symbol=symbol)
+    # Exponential, 0.5s, 1s, 2s, ..., with jitter to not retry in lockstep
+    return 0.5 * 2 ** attempt * random.uniform(0.5, 1.5)
+
+
+def grab(symbol_or_isin):
+    raw_data = _grab_raw(symbol_or_isin)
+    return _parse_market_data(raw_data)
+
+
+def grab_if_modified(symbol_or_isin, since=None, symbol=None):
+    """
+    Makes conditional request using validators saved by previous call.
+    Returns MarketData and a callback to save new validators,
+    which should be called once data is stored, or (None, None) if not modified.
+    Passing last stored tick time as since skips parsing older ticks,
+    passing resolved symbol labels metrics with it even if stock is given by isin.
+    """
+    symbol = symbol or symbol_or_isin
+    response = _request(symbol_or_isin, headers=_conditional_headers(symbol_or_isin), symbol=symbol)
+    if response.status_code == 304:
+        METRICS.count('not_modified', symbol=symbol)
+        return None, None
+
+    data = _parse_market_data(response.text, since=since, symbol=symbol)
+    return data, lambda: _save_validators(symbol_or_isin, response)
+
+
+def _grab_raw(symbol_or_isin):
+    return _request(symbol_or_isin).text
+
+
+def _parse_market_data(raw_data, since=None, symbol=None):
+    with METRICS.timer('parse'):
+        data = MarketData(*_parse_raw(raw_data, since=since))
+    METRICS.count('ticks_fetched', len(data), symbol=symbol or data.symbol)
+    return data
+
+
+HTTP_TRIES = 3
+
+
+def _request(symbol_or_isin, headers=None, symbol=None):
+    """
+    Requests ticks retrying network errors, metrics are labeled with symbol if given.
+    """
+    symbol = symbol or symbol_or_isin
+    # Not using funcy.retry() since it would need requests imported to be applied
+    for attempt in range(HTTP_TRIES):
+        try:
+            return _request_once(symbol_or_isin, headers, symbol)
+        except requests.RequestException:
+            if attempt == HTTP_TRIES - 1:
+                raise
+            time.sleep(_backoff(attempt, symbol))
+
+
+def _request_once(symbol_or_isin, headers=None, symbol=None):
+    with SIX_THROTTLE, METRICS.timer('http'):
+        response = _get_session().get(SIX_URL, params={'id': symbol_or_isin},
+                                      headers=headers, timeout=HTTP_TIMEOUT)
+    METRICS.count('http_requests', symbol=symbol)
+    if 'not_found' in response.url:
+        _exit("Security %s is not found." % symbol_or_isin)
+    METRICS.count('bytes_downloaded', len(response.content or b''), symbol=symbol)
+    return response
+
+
+def _conditional_headers(symbol_or_isin):
+    doc = _get_db().http_cache.find_one({'_id': symbol_or_isin}) or {}
+    headers = {}
+    if doc.get('etag'):
+        headers['If-None-Match'] = doc['etag']
+    if doc.get('last_modified'):
+        headers['If-Modified-Since'] = doc['last_modified']
+    return headers
+
+
+def _save_validators(symbol_or_isin, response):
+    validators = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+    if any(validators.values()):
+        _get_db().http_cache.replace_one({'_id': symbol_or_isin}, validators, upsert=True)
+
+
+def _parse_raw(raw_data, since=None):
+    """
+    Parses SIX CSV, returns symbol, isin and time ordered ticks.
+    Passing since keeps only ticks from that second on, rows are scanned newest first
+    and parsing stops at older ones. The whole since second is kept, it could get more trades.
+    """
+    reader = csv.reader(io.StringIO(raw_data), delimiter=';')
+
+    symbol, isin = re_find(r'\((\w+)\/(\w+)\)', next(reader)[0])
+    # All ticks are from the same day, so parse date only once
+    year, month, day = _parse_date(next(reader)[0].strip())
+    next(reader)  # Column titles
+
+    # Times are zero padded, so they could be compared as strings
+    cutoff = None
+    if since is not None:
+        date = datetime.date(year, month, day)
+        if date < since.date():
+            return symbol, isin, []
+        if date == since.date():
+            cutoff = since.strftime('%H:%M:%S')
+
+    data = []
+    for row in reader:
+        if not row or not row[0].strip():
+            continue
+        t, price, volume, *_ = row
+        t = t.strip()
+        if cutoff and t < cutoff:
+            break
+        dt = datetime.datetime(year, month, day, *_parse_time(t))
+        data.append((dt, float(price), int(volume)))
+    # Ticks come newest first
+    data.reverse()
+
+    return symbol, isin, data
+
+
+# Data export/import functions
+
+class BrokenFile(Exception):
+    pass
+
+class LegacyFile(Exception):
+    """Raised when file is readable, but could not be appended in place."""
+
+
+# JSON is written one tick per line followed by a fixed trailer,
+# so appending only needs to overwrite the trailer.
+JSON_TRAILER = '\n]}\n'
+
+def _write_json(f, data, last_dt=EPOCH, append=False, trailer=True):
+    # Write ticks one by one instead of json.dump() to not hold them all in memory
+    if not append:
+        f.write('{"symbol": %s, "isin": %s, %s: [' % (json.dumps(data.symbol), json.dumps(data.isin),
+                                                      json.dumps(data.json_key)))
+    sep = ',\n' if append else '\n'
+    for tick in data.encoded_rows(start=last_dt):
+        f.write(sep + json.dumps(tick))
+        sep = ',\n'
+    if trailer:
+        f.write(JSON_TRAILER)
+
+def _read_json(f):
+    try:
+        raw = json.load(f)
+        return MarketData.from_rows(raw['symbol'], raw['isin'], raw['ticks'])
+    except (ValueError, KeyError):
+        raise BrokenFile
+
+def _peek_json(f):
+    trailer = JSON_TRAILER.encode()
+    end = f.seek(0, os.SEEK_END) - len(trailer)
+    if end < 0:
+        raise BrokenFile
+    f.seek(end)
+    if f.read() != trailer:
+        raise LegacyFile
+
+    # Last line before trailer is either last tick or header if there are no ticks
+    line, _ = _last_line(f, end)
+    if line.startswith(b'{'):
+        return EPOCH, 0
+    try:
+        last_dt = parse_datetime(json.loads(line.decode())[0])
+    except (IndexError, ValueError, TypeError):
+        raise BrokenFile
+
+    return last_dt, end
+
+
+def _write_csv(f, data, last_dt=EPOCH, append=False):
+    writer = csv.writer(f, delimiter=';')
+    writer.writerows(data.encoded_rows(start=last_dt))
+
+def _read_csv(f):
+    try:
+        reader = csv.reader(f, delimiter=';')
+        return MarketData.from_rows(None, None, reader)
+    except ValueError:
+        raise BrokenFile
+
+def _peek_csv(f):
+    """
+    Finds last record seeking backwards from the end of file.
+    Returns its time and offset to continue writing from.
+    """
+    end = f.seek(0, os.SEEK_END)
+    while end > 0:
+        line, start = _last_line(f, end)
+        # Skip trailing empty lines and unterminated last line if it's a leftover
+        # of interrupted write. Both are overwritten. Complete one is kept,
+        # save_data() terminates it before appending.
+        if line.endswith(b'\n') and line.strip() or _is_csv_tick(line):
+            break
+        end = start
+    else:
+        return EPOCH, 0
+
+    try:
+        last_dt = parse_datetime(line.decode().split(';')[0])
+    except (IndexError, ValueError):
+        raise BrokenFile
+
+    return last_dt, end
+
+
+def _is_csv_tick(line):
+    try:
+        MarketData.from_rows(None, None, [line.decode().split(';')])
+    except ValueError:
+        return False
+    return True
+
+
+# Binary format is a header followed by chunks, each appended chunk being
+# int64 count and then count of int64 timestamps, float64 prices and int64 volumes,
+# all little-endian and 8 bytes aligned, so that columns could be memory-mapped.
+BINARY_MAGIC = b'SIXTCK01'
+BINARY_CHUNK_SIZE = 1000000
+
+def _write_binary(f, data, last_dt=EPOCH, append=False):
+    if not append:
+        symbol, isin = (data.symbol or '').encode(), (data.isin or '').encode()
+        header = BINARY_MAGIC + struct.pack('<HH', len(symbol), len(isin)) + symbol + isin
+        f.write(header + b'\0' * (-len(header) % 8))
+
+    if isinstance(data, MarketData):
+        _write_chunk(f, data.slice(start=last_dt + SECOND))
+    else:
+        # Streamed data is written by chunks to not hold it all in memory
+        ticks = (tick for tick in data if tick[0] > last_dt)
+        for batch in chunks(BINARY_CHUNK_SIZE, ticks):
+            _write_chunk(f, MarketData(None, None, batch))
+
+def _write_chunk(f, data):
+    if not len(data):
+        return
+    f.write(struct.pack('<q', len(data)))
+    for column, typecode in [(data.times, 'q'), (data.prices, 'd'), (data.volumes, 'q')]:
+        if sys.byteorder == 'big':
+            column = array(typecode, column)
+            column.byteswap()
+        f.write(column)
+
+def _read_binary(f):
+    """
+    Reads binary file memory mapping its columns, no copying is done
+    unless file has several chunks.
+    """
+    if not os.fstat(f.fileno()).st_size:
+        # Empty files, e.g. left by interrupted writes, can't be mapped
+        raise BrokenFile
+    buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    symbol, isin, pos = _read_binary_header(buf)
+
+    columns = []
+    for pos, count in _binary_chunks(buf, pos):
+        ends = [pos + 8 + 8 * count * i for i in range(1, 4)]
+        columns.append([
+            _binary_column(buf[start:end], typecode)
+            for start, end, typecode in zip([pos + 8] + ends, ends, 'qdq')
+        ])
+
+    data = MarketData(symbol.decode() or None, isin.decode() or None)
+    if len(columns) == 1:
+        data.times, data.prices, data.volumes = columns[0]
+    else:
+        for chunk in columns:
+            for column, chunk_column in zip([data.times, data.prices, data.volumes], chunk):
+                column.frombytes(memoryview(chunk_column).cast('B'))
+    return data
+
+def _peek_binary(f):
+    size = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    _, _, pos = _read_binary_header(f.read(min(size, 1024)))
+
+    last_dt = EPOCH
+    for pos, count in _binary_chunks(f, pos, size):
+        f.seek(pos + 8 + 8 * (count - 1))
+        last_dt = from_timestamp(struct.unpack('<q', f.read(8))[0])
+        pos += 8 + 24 * count
+    return last_dt, pos
+
+def _read_binary_header(buf):
+    if bytes(buf[:8]) != BINARY_MAGIC or len(buf) < 12:
+        raise BrokenFile
+    symbol_len, isin_len = struct.unpack('<HH', buf[8:12])
+    end = 12 + symbol_len + isin_len
+    if len(buf) < end:
+        raise BrokenFile
+    return bytes(buf[12:12 + symbol_len]), bytes(buf[12 + symbol_len:end]), end + -end % 8
+
+def _binary_chunks(f, pos, size=None):
+    """
+    Yields (offset, count) of complete chunks in file or buffer.
+    Incomplete last chunk, a leftover of interrupted write, is skipped.
+    """
+    if size is None:
+        size = len(f)
+    while pos + 8 <= size:
+        if isinstance(f, memoryview):
+            header = f[pos:pos + 8]
+        else:
+            f.seek(pos)
+            header = f.read(8)
+        count, = struct.unpack('<q', header)
+        if count <= 0 or pos + 8 + 24 * count > size:
+            break
+        yield pos, count
+        pos += 8 + 24 * count
+
+def _binary_column(buf, typecode):
+    if sys.byteorder == 'big':
+        column = array(typecode, bytes(buf))
+        column.byteswap()
+        return column
+    return buf.cast(typecode)
+
+
+TAIL_CHUNK_SIZE = 64 * 1024
+
+def _last_line(f, end):
+    """
+    Returns last line in binary file f ending at end offset along with its offset.
+    Reads file backwards by chunks, so cost doesn't depend on file size.
+    """
+    pos = end
+    buf = b''
+    while pos > 0:
+        step = min(TAIL_CHUNK_SIZE, pos)
+        pos -= step
+        f.seek(pos)
+        buf = f.read(step) + buf
+        # Skip last byte, it's a line terminator of the line itself
+        i = buf.rfind(b'\n', 0, len(buf) - 1)
+        if i >= 0:
+            return buf[i + 1:], pos + i + 1
+    return buf, 0
+
+
+# Compressed CSV and JSON files are a sequence of gzip members or zstd frames,
+# each append adding new ones. A file ends with a pointer, which decompresses
+# to nothing, holding offset to continue writing from and time of the last tick,
+# so appending doesn't need to decompress anything. JSON trailer goes
+# into a separate member before the pointer, so that it could be cut off.
+POINTER_MAGIC = b'SIXTAIL1'
+POINTER = struct.Struct('<8sqq')
+
+
+class GzipCodec:
+    """
+    Writes gzip members, pointer is an empty member with the payload in its extra field.
+    """
+    extension = 'gz'
+    errors = (OSError, EOFError, zlib.error)
+    pointer_size = 10 + 2 + 4 + POINTER.size + 2 + 8
+
+    def writer(self, raw):
+        return gzip.GzipFile(filename='', fileobj=raw, mode='wb', compresslevel=6, mtime=0)
+
+    def reader(self, raw):
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+
+    def pointer(self, payload):
+        extra = b'SX' + struct.pack('<H', len(payload)) + payload
+        # Header with FEXTRA flag, zero mtime and unknown OS, then empty final block, crc and size
+        return (b'\x1f\x8b\x08\x04\0\0\0\0\0\xff' + struct.pack('<H', len(extra)) + extra
+                + b'\x03\x00' + b'\0' * 8)
+
+    def read_pointer(self, buf):
+        return buf[16:16 + POINTER.size] if buf == self.pointer(buf[16:16 + POINTER.size]) else None
+
+
+class ZstdCodec:
+    """
+    Writes zstd frames, pointer is a skippable frame.
+    """
+    extension = 'zst'
+    pointer_size = 8 + POINTER.size
+
+    @property
+    def errors(self):
+        return (OSError, EOFError, zstandard.ZstdError)
+
+    def writer(self, raw):
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+
+    def reader(self, raw):
+        return zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=False)
+
+    def pointer(self, payload):
+        return struct.pack('<II', 0x184D2A5E, len(payload)) + payload
+
+    def read_pointer(self, buf):
+        return buf[8:] if buf[:8] == struct.pack('<II', 0x184D2A5E, POINTER.size) else None
+
+
+CODECS = {'gz': GzipCodec, 'zst': ZstdCodec}
+
+
+def _get_codec(compression):
+    if compression not in CODECS:
+        _exit("Unknown compression %s, choose one of %s." % (compression, ', '.join(CODECS)))
+    if compression == 'zst' and zstandard is None:
+        _exit("Install zstandard package to use *.zst files.")
+    return CODECS[compression]()
+
+
+def _split_filename(filename):
+    """
+    Splits file name into stem, format and compression, e.g. ABBN.csv.gz into ABBN, csv and gz.
+    """
+    stem, ext = os.path.splitext(os.path.basename(filename))
+    compression = None
+    if ext[1:] in CODECS:
+        compression = ext[1:]
+        stem, ext = os.path.splitext(stem)
+    return stem, ext[1:], compression
+
+
+def _default_filename(name, format, compress=None):
+    return '%s.%s' % (name, format) + ('.' + compress if compress else '')
+
+
+class _LastRow:
+    """
+    Wraps data remembering the last encoded row.
+    """
+    __slots__ = ('data', 'row')
+
+    def __init__(self, data):
+        self.data = data
+        self.row = None
+
+    def __getattr__(self, name):
+        return getattr(self.data, name)
+
+    def encoded_rows(self, start=EPOCH):
+        for row in self.data.encoded_rows(start=start):
+            self.row = row
+            yield row
+
+    def last_time(self, default=EPOCH):
+        # Only tick files could be appended, others have no time in the first column
+        if self.row is None or not isinstance(self.data, (MarketData, TickStream)):
+            return default
+        return parse_datetime(self.row[0])
+
+
+def _write_compressed(raw, codec, format, data, last_dt=EPOCH, append=False, pointer=True):
+    data = _LastRow(data)
+    write = partial(_write_json, trailer=False) if format == 'json' else _write_csv
+    with io.TextIOWrapper(codec.writer(raw), encoding='utf-8', newline='') as f:
+        write(f, data, last_dt, append=append)
+
+    offset = raw.tell() if pointer else None
+    if format == 'json':
+        with codec.writer(raw) as f:
+            f.write(JSON_TRAILER.encode())
+    if pointer:
+        payload = POINTER.pack(POINTER_MAGIC, offset, to_timestamp(data.last_time(default=last_dt)))
+        raw.write(codec.pointer(payload))
+
+
+def _peek_compressed(f, codec):
+    end = f.seek(0, os.SEEK_END)
+    if end < codec.pointer_size:
+        raise LegacyFile
+    f.seek(end - codec.pointer_size)
+    payload = codec.read_pointer(f.read(codec.pointer_size))
+    if payload is None:
+        raise LegacyFile
+
+    magic, offset, last_ts = POINTER.unpack(payload)
+    if magic != POINTER_MAGIC or not 0 < offset <= end - codec.pointer_size:
+        raise BrokenFile
+    # Nothing to continue, e.g. only JSON header, so rewrite it all
+    if not last_ts:
+        return EPOCH, 0
+    return from_timestamp(last_ts), offset
+
+
+def save_data(data, format=None, mode='strict', filename=None, compress=None):
+    """
+    Writes data to file, compressing it if file extension is .gz or .zst or compress is given.
+    """
+    assert format in {'csv', 'json', 'bin'}
+    assert mode in {'strict', 'append', 'overwrite'}
+
+    IMPLEMENTATIONS = {
+        'json': (_write_json, _peek_json, False),
+        'csv': (_write_csv, _peek_csv, False),
+        'bin': (_write_binary, _peek_binary, True),
+    }
+    write, peek, binary = IMPLEMENTATIONS[format]
+
+    if not filename:
+        filename = _default_filename(data.symbol, format, compress)
+    elif filename != '-':
+        if _split_filename(filename)[2]:
+            compress = _split_filename(filename)[2]
+        elif compress:
+            # Compressed file gets its extension, so it's loaded back as such
+            filename += '.' + compress
+    codec = _get_codec(compress) if compress else None
+    if codec and binary:
+        _exit("Binary files are memory-mapped, so they could not be compressed.")
+
+    if filename == '-':
+        if codec:
+            _write_compressed(sys.stdout.buffer, codec, format, data, pointer=False)
+        else:
+            write(sys.stdout.buffer if binary else sys.stdout, data)
+        return
+
+    # Find where to continue writing from, 0 means write from scratch
+    last_dt, offset = EPOCH, 0
+    if os.path.exists(filename):
+        if mode == 'append':
+            try:
+                last_dt, offset = _peek_file(filename, format, codec)
+            except BrokenFile:
+                _exit('File %s format is broken. Remove it or use --overwrite.' % filename)
+        elif mode == 'strict':
+            _exit('File %s already exists. Use --append or --overwrite.' % filename)
+
+    raw = open(filename, 'r+b' if offset else 'wb')
+    raw.truncate(offset)
+    raw.seek(offset)
+    if offset and format == 'csv' and not codec:
+        # Last record could have been written without line terminator by other tools
+        raw.seek(offset - 1)
+        if raw.read(1) != b'\n':
+            raw.write(b'\n')
+    if codec:
+        with raw:
+            _write_compressed(raw, codec, format, data, last_dt, append=bool(offset))
+        return
+    with raw if binary else io.TextIOWrapper(raw, encoding='utf-8', newline='') as f:
+        write(f, data, last_dt, append=bool(offset))
+
+
+def _peek_file(filename, format, codec=None):
+    PEEKERS = {'json': _peek_json, 'csv': _peek_csv, 'bin': _peek_binary}
+    peek = partial(_peek_compressed, codec=codec) if codec else PEEKERS[format]
+    with open(filename, 'rb') as f:
+        try:
+            return peek(f)
+        except LegacyFile:
+            pass
+
+    _warn("Converting %s to append friendly layout..." % filename)
+    _convert_file(filename, format, codec)
+    with open(filename, 'rb') as f:
+        return peek(f)
+
+
+def _convert_file(filename, format='json', codec=None):
+    """
+    Rewrites JSON or compressed file in append friendly layout.
+    """
+    with open(filename, 'rb') as f:
+        data = _read_file(f, format, codec)
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        if codec:
+            _write_compressed(f, codec, format, data)
+        else:
+            with io.TextIOWrapper(f, encoding='utf-8', newline='') as text:
+                _write_json(text, data)
+    os.replace(tmp_filename, filename)
+
+
+def load_data(filename, symbol_or_isin=None, format=None):
+    data = _read_data(filename, format=format)
+    # Guessing symbol/isin, needed for CSV files.
+    if not data.symbol:
+        _set_stock(data, filename, symbol_or_isin, find_stock(symbol_or_isin or _filename_stem(filename)))
+    return data
+
+
+def _read_data(filename, format=None):
+    _, extension, compression = _split_filename(filename)
+    if not format:
+        format = extension
+        if format not in {'json', 'csv', 'bin'}:
+            _exit("Don't know how to read *.%s files. "
+                  "Try specifying format explicitely with --csv, --json or --binary." % format)
+    codec = _get_codec(compression) if compression else None
+
+    # Reading file
+    try:
+        with open(filename, 'rb') as f:
+            return _read_file(f, format, codec)
+    except FileNotFoundError:
+        _exit("File %s not found." % filename)
+    except BrokenFile:
+        _exit("File %s format is broken." % filename)
+
+
+def _read_file(f, format, codec=None):
+    READERS = {'json': _read_json, 'csv': _read_csv, 'bin': _read_binary}
+
+    if format == 'bin':
+        if codec:
+            raise BrokenFile
+        return _read_binary(f)
+    try:
+        with io.TextIOWrapper(codec.reader(f) if codec else f, encoding='utf-8') as text:
+            return READERS[format](text)
+    except codec.errors if codec else ():
+        raise BrokenFile
+
+
+def _filename_stem(filename):
+    stem, _, _ = _split_filename(filename)
+    return stem
+
+
+def _set_stock(data, filename, symbol_or_isin, stock):
+    if not stock:
+        if symbol_or_isin:
+            _exit("Stock %s not registered in database." % symbol_or_isin)
+        else:
+            _exit("Can't guess stock for %s file. Use --as to specify." % filename)
+
+    data.symbol = stock['symbol']
+    data.isin = stock['isin']
+
+
+def _expand_paths(paths, format=None):
+    """
+    Expands globs and directories into a list of files.
+    Directories are searched recursively for files of given format or any known one.
+    """
+    formats = [format] if format else ['csv', 'json', 'bin']
+    extensions = tuple('.' + format + suffix for format in formats for suffix in ['', '.gz', '.zst'])
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in sorted(os.walk(path)):
+                filenames.extend(os.path.join(directory, name) for name in sorted(names)
+                                 if name.endswith(extensions))
+        else:
+            # Nonexistent file is kept as is to be reported when reading it
+            filenames.extend(sorted(glob.glob(path)) or [path])
+    return list(dict.fromkeys(filenames))
+
+
+def _parse_files(filenames, format=None, workers=1):
+    """
+    Yields (filename, data) in order, data is None if file failed to parse.
+    Files are parsed by worker processes if there are several workers,
+    no more than twice as many files as workers are parsed ahead.
+    """
+    def result(future):
+        # Failure is reported by worker itself, SystemExit is re-raised here
+        with suppress(SystemExit):
+            return future.result()
+
+    if workers == 1:
+        for filename in filenames:
+            data = None
+            with suppress(SystemExit):
+                data = _read_data(filename, format)
+            yield filename, data
+        return
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Forking is unsafe once insert thread and MongoDB client threads are running
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as executor:
+        pending = deque()
+        for filename in filenames:
+            pending.append((filename, executor.submit(_read_data, filename, format)))
+            if len(pending) >= 2 * workers:
+                filename, future = pending.popleft()
+                yield filename, result(future)
+        for filename, future in pending:
+            yield filename, result(future)
+
+
+# Database data functions
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _get_client():
+    """
+    Returns process wide MongoDB client, configured by environment variables.
+    It's thread-safe and keeps a pool of connections, so there is no point in having more.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            options = {}
+            if 'SIX_SCRAPER_MONGO_POOL_SIZE' in os.environ:
+                options['maxPoolSize'] = int(os.environ['SIX_SCRAPER_MONGO_POOL_SIZE'])
+            if 'SIX_SCRAPER_MONGO_TIMEOUT' in os.environ:
+                timeout_ms = int(float(os.environ['SIX_SCRAPER_MONGO_TIMEOUT']) * 1000)
+                options['serverSelectionTimeoutMS'] = options['connectTimeoutMS'] = timeout_ms
+            if 'SIX_SCRAPER_MONGO_W' in os.environ:
+                w = os.environ['SIX_SCRAPER_MONGO_W']
+                options['w'] = int(w) if w.isdigit() else w
+            _client = pymongo.MongoClient(os.environ.get('SIX_SCRAPER_MONGO_URI'), **options)
+            atexit.register(_client.close)
+    return _client
+
+
+def _get_db():
+    return _get_client()[os.environ.get('SIX_SCRAPER_DB', 'smi')]
+
+
+class StockResolver:
+    """
+    Keeps stocks collection in memory as symbol and isin dicts.
+    It's loaded with a single query on first use and reloaded once ttl seconds pass
+    or after invalidate(), which commands changing stocks call.
+    """
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._by_symbol = self._by_isin = {}
+
+    def find(self, symbol_or_isin):
+        by_symbol, by_isin = self._load()
+        return by_symbol.get(symbol_or_isin) or by_isin.get(symbol_or_isin)
+
+    def find_many(self, stocks):
+        """Returns found stocks in order, each one once."""
+        by_symbol, by_isin = self._load()
+        records = (by_symbol.get(stock) or by_isin.get(stock) for stock in stocks)
+        return list({record['symbol']: record for record in records if record}.values())
+
+    def all(self):
+        by_symbol, _ = self._load()
+        return list(by_symbol.values())
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _load(self):
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+                records = list(_get_db().stocks.find({}, {'_id': False, 'symbol': True, 'isin': True}))
+                self._by_symbol = {record['symbol']: record for record in records}
+                self._by_isin = {record['isin']: record for record in records}
+                self._loaded_at = time.monotonic()
+            return self._by_symbol, self._by_isin
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def _get_resolver():
+    """
+    Returns process wide stock resolver, SIX_SCRAPER_STOCKS_TTL sets its ttl in seconds.
+    """
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = StockResolver(ttl=float(os.environ.get('SIX_SCRAPER_STOCKS_TTL', 300)))
+    return _resolver
+
+
+def find_stock(symbol_or_isin):
+    return _get_resolver().find(symbol_or_isin)
+
+
+def find_stocks(stocks):
+    """
+    Finds stocks by symbols or isins, warns about not found ones.
+    """
+    records = _get_resolver().find_many(stocks)
+    found = set(cat((r['symbol'], r['isin']) for r in records))
+    not_found = lremove(found, stocks)
+    if not_found:
+        _warn("Stocks %s are not found in database." % ', '.join(not_found))
+    return records
+
+
+INSERT_BATCH_SIZE = 10000
+CURSOR_BATCH_SIZE = 10000
+DUPLICATE_KEY = 11000
+
+
+def save_data_to_db(data, batch_size=INSERT_BATCH_SIZE, progress=None, last_time=None):
+    """
+    Inserts new ticks in unordered batches, returns number of added ones.
+
+    Ticks are keyed by (symbol, time, seq), seq numbering trades within the same second
+    in download order, so saving overlapping data again doesn't produce duplicates,
+    while seconds which changed since are replaced, see TickStore.save().
+    Optional progress callback is called with (processed, total) after each batch.
+    Passing last stored tick time if it's known saves a database query.
+
+    Rollups, digests and cache are updated from the first changed tick on,
+    rollups only up to the last saved tick, later bars are left alone.
+    """
+    store = _get_store()
+    if last_time is None:
+        with METRICS.timer('last_time'):
+            last_time = store.last_time(data.symbol)
+    with METRICS.timer('insert'):
+        inserted, since = store.save(data, batch_size=batch_size, progress=progress, last_time=last_time)
+    METRICS.count('ticks_inserted', inserted, symbol=data.symbol)
+    if since:
+        with METRICS.timer('rollups'):
+            until = from_timestamp(data.times[-1])
+            update_rollups(data.symbol, data.isin, since=since, until=until, batch_size=batch_size)
+        cache = _get_cache()
+        if cache:
+            cache.invalidate(data.symbol, since=since)
+    return inserted
+
+
+def load_data_from_db(symbol_or_isin, from_=None, to=None):
+    """
+    Loads stock ticks from database into MarketData.
+    """
+    # Find stock
+    stock = find_stock(symbol_or_isin)
+    if stock is None:
+        _exit("Stock %s is not found in database." % symbol_or_isin)
+
+    # Construct MarketData
+    data = find_ticks(stock['symbol'], from_=from_, to=to)
+    return MarketData(stock['symbol'], stock['isin'], data)
+
+
+# Tick storage backends
+
+def _get_store(name=None):
+    """
+    Returns ticks storage backend, chosen by SIX_SCRAPER_STORAGE environment variable.
+    """
+    name = name or os.environ.get('SIX_SCRAPER_STORAGE', 'ticks')
+    if name not in STORES:
+        _exit("Unknown storage %s, choose one of %s." % (name, ', '.join(STORES)))
+    return STORES[name](_get_db())
+
+
+class TickStore:
+    """
+    A base for ticks storage backends.
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def save(self, data, batch_size=INSERT_BATCH_SIZE, progress=None, last_time=None):
+        """
+        Merges data into stored ticks, returns number of added ticks and time of the first changed one.
+
+        Seconds of data up to the last stored one are compared with stored ticks in a single pass,
+        ones which differ are replaced as a whole, so that both late trades and corrections get in.
+        Stored seconds missing from data are kept as is, since data could be partial.
+        """
+        if last_time is None:
+            last_time = self.last_time(data.symbol)
+        added, removed = self._diff(data.symbol, data.slice(end=last_time)) if last_time else ([], [])
+        if removed:
+            self.remove_times(data.symbol, sorted({tick[0] for tick in removed}))
+            METRICS.count('ticks_replaced', len(removed), symbol=data.symbol)
+
+        newer = data.slice(start=last_time + SECOND) if last_time else data
+        ticks = MarketData.concat(data.symbol, data.isin, [MarketData(None, None, added), newer])
+        skipped = self.insert(data.symbol, data.isin, ticks, batch_size=batch_size, progress=progress)
+        update_digests(data.symbol, data.isin, added=ticks, removed=removed, skipped=skipped)
+        inserted = len(ticks) - len(skipped)
+        return inserted - len(removed), from_timestamp(ticks.times[0]) if len(ticks) else None
+
+    def _diff(self, symbol, overlap):
+        """
+        Compares ticks with stored ones second by second, reading stored ones with a single query.
+        Returns ticks of seconds which differ and stored ticks of those seconds.
+        """
+        if not len(overlap):
+            return [], []
+        from_, to = from_timestamp(overlap.times[0]), from_timestamp(overlap.times[-1])
+        stored = groupby(self.find(symbol, from_=from_, to=to), itemgetter(0))
+        stored_dt, stored_ticks = next(stored, (None, None))
+
+        added, removed = [], []
+        for dt, ticks in groupby(overlap, itemgetter(0)):
+            while stored_dt is not None and stored_dt < dt:
+                stored_dt, stored_ticks = next(stored, (None, None))
+            ticks = list(ticks)
+            old = list(stored_ticks) if stored_dt == dt else []
+            if ticks != old:
+                added.extend(ticks)
+                removed.extend(old)
+        return added, removed
+
+    def setup(self):
+        raise NotImplementedError
+
+    def last_time(self, symbol):
+        raise NotImplementedError
+
+    def insert(self, symbol, isin, ticks, batch_size=INSERT_BATCH_SIZE, progress=None):
+        """
+        Inserts ticks skipping already stored ones,
+        returns skipped ones as (time, seq, price, volume) tuples.
+        """
+        raise NotImplementedError
+
+    def remove_times(self, symbol, times):
+        """Removes all ticks of a stock at given seconds."""
+        raise NotImplementedError
+
+    def find(self, symbol, from_=None, to=None):
+        """Yields (time, price, volume) tuples in time order."""
+        for _, t, price, volume in self.find_many([symbol], from_=from_, to=to):
+            yield t, price, volume
+
+    def find_columns(self, symbol, from_=None, to=None):
+        """Returns ticks as MarketData without isin."""
+        return MarketData(symbol, None, self.find(symbol, from_=from_, to=to))
+
+    def find_many(self, symbols, from_=None, to=None):
+        """Yields (symbol, time, price, volume) tuples ordered by symbol and time."""
+        raise NotImplementedError
+
+    def remove(self, stocks):
+        """Removes data of given symbols or isins, returns number of removed documents."""
+        raise NotImplementedError
+
+    def symbols(self):
+        raise NotImplementedError
+
+
+class DocumentStore(TickStore):
+    """
+    Stores each tick as a separate document in ticks collection.
+    """
+    def setup(self):
+        # Ticks saved by older versions have no seq, number them before making index unique
+        self._number_ticks()
+        with suppress(pymongo.errors.OperationFailure):
+            self.db.ticks.drop_index([('symbol', pymongo.ASCENDING), ('time', pymongo.ASCENDING)])
+        self.db.ticks.create_index([('symbol', pymongo.ASCENDING), ('time', pymongo.ASCENDING),
+                                    ('seq', pymongo.ASCENDING)], unique=True)
+
+    def _number_ticks(self):
+        docs = self.db.ticks.find({'seq': {'$exists': False}}, {'symbol': True, 'time': True}) \
+                            .sort([('symbol', pymongo.ASCENDING), ('time', pymongo.ASCENDING),
+                                   ('_id', pymongo.ASCENDING)])
+        prev_key, seq = None, 0
+        updates = []
+        for doc in docs:
+            key = doc['symbol'], doc['time']
+            seq = seq + 1 if key == prev_key else 0
+            prev_key = key
+            updates.append(pymongo.UpdateOne({'_id': doc['_id']}, {'$set': {'seq': seq}}))
+            if len(updates) >= INSERT_BATCH_SIZE:
+                self.db.ticks.bulk_write(updates, ordered=False)
+                updates = []
+        if updates:
+            self.db.ticks.bulk_write(updates, ordered=False)
+
+    def last_time(self, symbol):
+        doc = self.db.ticks.find_one({'symbol': symbol}, sort=[('time', -1)])
+        return doc['time'] if doc else None
+
+    def insert(self, symbol, isin, ticks, batch_size=INSERT_BATCH_SIZE, progress=None):
+        docs = ({
+            'symbol': symbol,
+            'isin': isin,
+            'time': t,
+            'seq': seq,
+            'price': price,
+            'volume': volume,
+        } for t, seq, price, volume in _numbered(ticks))
+        skipped = _insert_batches(self.db.ticks, docs, len(ticks), batch_size, progress)
+        return [itemgetter('time', 'seq', 'price', 'volume')(doc) for doc in skipped]
+
+    def remove_times(self, symbol, times):
+        self.db.ticks.delete_many({'symbol': symbol, 'time': {'$in': times}})
+
+    def find_columns(self, symbol, from_=None, to=None):
+        return _columns_from_docs(symbol, self._find_docs([symbol], from_, to, with_symbol=False))
+
+    def find_many(self, symbols, from_=None, to=None):
+        return map(itemgetter('symbol', 'time', 'price', 'volume'), self._find_docs(symbols, from_, to))
+
+    def _find_docs(self, symbols, from_=None, to=None, with_symbol=True):
+        query = {'symbol': {'$in': symbols}}
+        query.update(_range_query('time', from_, to))
+        projection = {'_id': False, 'time': True, 'price': True, 'volume': True}
+        if with_symbol:
+            projection['symbol'] = True
+        return self.db.ticks.find(query, projection) \
+                            .sort([('symbol', pymongo.ASCENDING), ('time', pymongo.ASCENDING),
+                                   ('seq', pymongo.ASCENDING)]) \
+                            .batch_size(CURSOR_BATCH_SIZE)
+
+    def remove(self, stocks):
+        query = {'$or': [
+            {'symbol': {'$in': stocks}},
+            {'isin': {'$in': stocks}},
+        ]}
+        return self.db.ticks.delete_many(query).deleted_count
+
+    def symbols(self):
+        return self.db.ticks.distinct('symbol')
+
+
+class BucketStore(TickStore):
+    """
+    Packs ticks into a document per symbol and day in tick_buckets collection.
+    Ticks are kept in arrays of seconds since start of day, prices and volumes,
+    sorted by time and then by seq, with time range in bucket header.
+    """
+    def setup(self):
+        self.db.tick_buckets.create_index([('symbol', pymongo.ASCENDING), ('day', pymongo.ASCENDING)],
+                                          unique=True)
+        self.db.tick_buckets.create_index('isin')
+
+    def last_time(self, symbol):
+        doc = self.db.tick_buckets.find_one({'symbol': symbol}, {'end': True}, sort=[('day', -1)])
+        return doc['end'] if doc else None
+
+    def insert(self, symbol, isin, ticks, batch_size=INSERT_BATCH_SIZE, progress=None):
+        days = group_by(lambda tick: tick[0] // DAY, zip(ticks.times, ticks.prices, ticks.volumes))
+        days = [(from_timestamp(day * DAY), day_ticks) for day, day_ticks in sorted(days.items())]
+        old = {doc['day']: doc for doc in self.db.tick_buckets.find(
+            {'symbol': symbol, 'day': {'$in': [day for day, _ in days]}})}
+
+        skipped = []
+        processed = pending = 0
+        updates = []
+        for i, (day, day_ticks) in enumerate(days):
+            bucket, day_skipped = self._merge(old.get(day), symbol, isin, day, day_ticks)
+            skipped.extend((day + datetime.timedelta(seconds=t), seq, price, volume)
+                           for t, seq, price, volume in day_skipped)
+            if len(day_skipped) < len(day_ticks):
+                pending += bucket['count']
+                updates.append(pymongo.ReplaceOne({'symbol': symbol, 'day': day}, bucket, upsert=True))
+            processed += len(day_ticks)
+
+            # Buckets are replaced as a whole, so batch size is approximate
+            if pending >= batch_size or i == len(days) - 1:
+                if updates:
+                    self.db.tick_buckets.bulk_write(updates, ordered=False)
+                    updates, pending = [], 0
+                if progress:
+                    progress(processed, len(ticks))
+        return skipped
+
+    def remove_times(self, symbol, times):
+        for day, day_times in group_by(lambda dt: datetime.datetime.combine(dt.date(), datetime.time()),
+                                       times).items():
+            doc = self.db.tick_buckets.find_one({'symbol': symbol, 'day': day})
+            if not doc:
+                continue
+            start = to_timestamp(day)
+            removed = {to_timestamp(dt) - start for dt in day_times}
+            kept = [(start + t, price, volume) for t, price, volume
+                    in zip(doc['times'], doc['prices'], doc['volumes']) if t not in removed]
+            if kept:
+                bucket, _ = self._merge(None, symbol, doc['isin'], day, kept)
+                self.db.tick_buckets.replace_one({'symbol': symbol, 'day': day}, bucket)
+            else:
+                self.db.tick_buckets.delete_one({'symbol': symbol, 'day': day})
+
+    @staticmethod
+    def _merge(doc, symbol, isin, day, day_ticks):
+        """
+        Merges (timestamp, price, volume) ticks into bucket doc, skipping stored ones.
+        Returns new bucket and skipped (seconds since day start, seq, price, volume) ticks.
+        """
+        start = to_timestamp(day)
+        stored = zip(doc['times'], doc['prices'], doc['volumes']) if doc else ()
+        merged = {(t, seq): (price, volume) for t, seq, price, volume in _numbered(stored)}
+        skipped = []
+        new = ((t - start, price, volume) for t, price, volume in day_ticks)
+        for t, seq, price, volume in _numbered(new):
+            if (t, seq) in merged:
+                skipped.append((t, seq, price, volume))
+            else:
+                merged[t, seq] = price, volume
+
+        keys = sorted(merged)
+        bucket = {
+            'symbol': symbol,
+            'isin': isin,
+            'day': day,
+            'start': from_timestamp(start + keys[0][0]),
+            'end': from_timestamp(start + keys[-1][0]),
+            'count': len(keys),
+            'times': [t for t, _ in keys],
+            'prices': [merged[key][0] for key in keys],
+            'volumes': [merged[key][1] for key in keys],
+        }
+        return bucket, skipped
+
+    def find_columns(self, symbol, from_=None, to=None):
+        # Bucket arrays are appended as they are, only shifting times by day start
+        data = MarketData(symbol, None)
+        for bucket in self._find_buckets([symbol], from_, to):
+            data.times.extend(map(to_timestamp(bucket['day']).__add__, bucket['times']))
+            data.prices.extend(bucket['prices'])
+            data.volumes.extend(bucket['volumes'])
+        return data.slice(start=from_, end=to)
+
+    def find_many(self, symbols, from_=None, to=None):
+        for bucket in self._find_buckets(symbols, from_, to):
+            symbol, day = bucket['symbol'], bucket['day']
+            for t, price, volume in zip(bucket['times'], bucket['prices'], bucket['volumes']):
+                dt = day + datetime.timedelta(seconds=t)
+                if (not from_ or dt >= from_) and (not to or dt <= to):
+                    yield symbol, dt, price, volume
+
+    def _find_buckets(self, symbols, from_=None, to=None):
+        query = {'symbol': {'$in': symbols}}
+        if from_:
+            query['end'] = {'$gte': from_}
+        if to:
+            query['start'] = {'$lte': to}
+        projection = {'_id': False, 'symbol': True, 'day': True,
+                      'times': True, 'prices': True, 'volumes': True}
+        return self.db.tick_buckets.find(query, projection) \
+                                   .sort([('symbol', pymongo.ASCENDING), ('day', pymongo.ASCENDING)])
+
+    def remove(self, stocks):
+        query = {'$or': [
+            {'symbol': {'$in': stocks}},
+            {'isin': {'$in': stocks}},
+        ]}
+        return self.db.tick_buckets.delete_many(query).deleted_count
+
+    def symbols(self):
+        return self.db.tick_buckets.distinct('symbol')
+
+
+class TimeSeriesStore(TickStore):
+    """
+    Uses MongoDB 5.0+ time-series collection tick_series, which packs ticks into buckets
+    on server side. It doesn't support unique indexes, so only ticks newer than
+    the last stored second are saved and nothing is merged.
+    """
+    def setup(self):
+        if self.db.client.server_info()['versionArray'] < [5, 0]:
+            _exit("Time-series collections require MongoDB 5.0 or newer.")
+        if 'tick_series' not in self.db.list_collection_names():
+            self.db.create_collection('tick_series', timeseries={
+                'timeField': 'time', 'metaField': 'meta', 'granularity': 'seconds',
+            })
+        self.db.tick_series.create_index([('meta.symbol', pymongo.ASCENDING), ('time', pymongo.ASCENDING)])
+
+    def save(self, data, batch_size=INSERT_BATCH_SIZE, progress=None, last_time=None):
+        if last_time is None:
+            last_time = self.last_time(data.symbol)
+        ticks = data.slice(start=last_time + SECOND) if last_time else data
+        skipped = self.insert(data.symbol, data.isin, ticks, batch_size=batch_size, progress=progress)
+        update_digests(data.symbol, data.isin, added=ticks, skipped=skipped)
+        return len(ticks) - len(skipped), from_timestamp(ticks.times[0]) if len(ticks) else None
+
+    def last_time(self, symbol):
+        doc = self.db.tick_series.find_one({'meta.symbol': symbol}, sort=[('time', -1)])
+        return doc['time'] if doc else None
+
+    def insert(self, symbol, isin, ticks, batch_size=INSERT_BATCH_SIZE, progress=None):
+        docs = ({
+            'meta': {'symbol': symbol, 'isin': isin},
+            'time': t,
+            'seq': seq,
+            'price': price,
+            'volume': volume,
+        } for t, seq, price, volume in _numbered(ticks))
+        skipped = _insert_batches(self.db.tick_series, docs, len(ticks), batch_size, progress)
+        return [itemgetter('time', 'seq', 'price', 'volume')(doc) for doc in skipped]
+
+    def find_columns(self, symbol, from_=None, to=None):
+        return _columns_from_docs(symbol, self._find_docs([symbol], from_, to, with_symbol=False))
+
+    def find_many(self, symbols, from_=None, to=None):
+        for row in self._find_docs(symbols, from_, to):
+            yield row['meta']['symbol'], row['time'], row['price'], row['volume']
+
+    def _find_docs(self, symbols, from_=None, to=None, with_symbol=True):
+        query = {'meta.symbol': {'$in': symbols}}
+        query.update(_range_query('time', from_, to))
+        projection = {'_id': False, 'time': True, 'price': True, 'volume': True}
+        if with_symbol:
+            projection['meta.symbol'] = True
+        return self.db.tick_series.find(query, projection) \
+                                  .sort([('meta.symbol', pymongo.ASCENDING), ('time', pymongo.ASCENDING),
+                                         ('seq', pymongo.ASCENDING)]) \
+                                  .batch_size(CURSOR_BATCH_SIZE)
+
+    def remove(self, stocks):
+        query = {'$or': [
+            {'meta.symbol': {'$in': stocks}},
+            {'meta.isin': {'$in': stocks}},
+        ]}
+        return self.db.tick_series.delete_many(query).deleted_count
+
+    def symbols(self):
+        return self.db.tick_series.distinct('meta.symbol')
+
+
+def _columns_from_docs(symbol, docs):
+    """
+    Appends time, price and volume of tick documents straight to MarketData columns.
+    """
+    data = MarketData(symbol, None)
+    add_time, add_price, add_volume = data.times.append, data.prices.append, data.volumes.append
+    for doc in docs:
+        add_time(to_timestamp(doc['time']))
+        add_price(doc['price'])
+        add_volume(doc['volume'])
+    return data
+
+
+STORES = {
+    'ticks': DocumentStore,
+    'buckets': BucketStore,
+    'timeseries': TimeSeriesStore,
+}
+
+DAY = 24 * 60 * 60
+
+
+def _numbered(ticks):
+    """
+    Adds seq to (time, price, volume) ticks, numbering trades within the same second.
+    """
+    prev_t, seq = None, 0
+    for t, price, volume in ticks:
+        seq = seq + 1 if t == prev_t else 0
+        prev_t = t
+        yield t, seq, price, volume
+
+
+def _insert_batches(collection, docs, total, batch_size, progress):
+    """
+    Inserts docs in unordered batches, returns ones skipped as already stored.
+    """
+    skipped = []
+    processed = 0
+    for batch in chunks(batch_size, docs):
+        try:
+            collection.insert_many(batch, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            # Ignore already stored ticks
+            if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+                raise
+            skipped.extend(batch[error['index']] for error in e.details['writeErrors'])
+        processed += len(batch)
+        if progress:
+            progress(processed, total)
+    return skipped
+
+
+def _range_query(field, from_=None, to=None):
+    condition = {}
+    if from_:
+        condition['$gte'] = from_
+    if to:
+        condition['$lte'] = to
+    return {field: condition} if condition else {}
+
+
+# Rollups
+
+ROLLUPS = [('bars_1m', 60), ('bars_1d', DAY)]
+BAR_FIELDS = ['open', 'high', 'low', 'close', 'volume', 'turnover', 'count']
+
+
+def update_rollups(symbol, isin, since=None, until=None, batch_size=INSERT_BATCH_SIZE):
+    """
+    Recomputes minute bars from ticks and daily bars from minute bars.
+    Only bars containing since or later and until or earlier are touched,
+    all of them when neither is given.
+    """
+    db = _get_db()
+    collection, seconds = ROLLUPS[0]
+    start, end = _bar_start(since, seconds), _bar_end(until, seconds)
+    bars = _aggregate_ticks(_get_store().find(symbol, from_=start, to=end), seconds)
+    _upsert_bars(db[collection], symbol, isin, bars, batch_size)
+
+    for (source, _), (collection, seconds) in zip(ROLLUPS, ROLLUPS[1:]):
+        start, end = _bar_start(since, seconds), _bar_end(until, seconds)
+        bars = _aggregate_bars(_find_rollup(db[source], symbol, from_=start, to=end), seconds)
+        _upsert_bars(db[collection], symbol, isin, bars, batch_size)
+
+
+def find_bars(symbol, seconds, from_=None, to=None):
+    """
+    Yields raw bars of given length read from the coarsest fitting rollup.
+    """
+    collection = first(name for name, length in reversed(ROLLUPS) if seconds % length == 0)
+    if collection is None:
+        raise ValueError("No rollup fits %d seconds bars" % seconds)
+    return _aggregate_bars(_find_rollup(_get_db()[collection], symbol, from_, to), seconds)
+
+
+def remove_rollups(stocks):
+    db = _get_db()
+    query = {'$or': [
+        {'symbol': {'$in': stocks}},
+        {'isin': {'$in': stocks}},
+    ]}
+    for collection, _ in ROLLUPS:
+        db[collection].delete_many(query)
+
+
+def _bar_start(dt, seconds):
+    return from_timestamp(to_timestamp(dt) // seconds * seconds) if dt else None
+
+
+def _bar_end(dt, seconds):
+    """Returns last second of the bar containing dt."""
+    return _bar_start(dt, seconds) + datetime.timedelta(seconds=seconds) - SECOND if dt else None
+
+
+def _find_rollup(collection, symbol, from_=None, to=None):
+    query = dict({'symbol': symbol}, **_range_query('time', from_, to))
+    for doc in collection.find(query).sort('time', pymongo.ASCENDING):
+        yield [to_timestamp(doc['time'])] + [doc[field] for field in BAR_FIELDS]
+
+
+def _upsert_bars(collection, symbol, isin, bars, batch_size):
+    for batch in chunks(batch_size, bars):
+        updates = []
+        for bar in batch:
+            doc = dict(zip(BAR_FIELDS, bar[1:]), symbol=symbol, isin=isin, time=from_timestamp(bar[0]))
+            updates.append(pymongo.ReplaceOne({'symbol': symbol, 'time': doc['time']}, doc, upsert=True))
+        collection.bulk_write(updates, ordered=False)
+
+
+# Digests
+
+DIGEST_TICK = struct.Struct('<qqdq')
+
+
+def update_digests(symbol, isin, added=(), removed=(), skipped=()):
+    """
+    Updates tick counts and checksums of a stock per day in tick_digests collection.
+    Added and removed ticks should be whole seconds, so that seq could be derived.
+    Skipped are (time, seq, price, volume) ones of added, which turned out to be stored already.
+    Checksum is XOR of tick hashes, so it doesn't depend on order ticks are saved in.
+    """
+    changes = {}
+    for numbered, sign in [(_numbered(added), 1), (_numbered(removed), -1), (skipped, -1)]:
+        for day, count, checksum in _numbered_digests(numbered):
+            old_count, old_checksum = changes.get(day, (0, 0))
+            changes[day] = old_count + sign * count, old_checksum ^ checksum
+    if changes:
+        _save_digests(symbol, isin, changes, relative=True)
+
+
+def find_digests(symbol, days=None):
+    """
+    Returns {day: (count, checksum)} of a stock, only for given days if any.
+    """
+    query = {'symbol': symbol}
+    if days is not None:
+        query['day'] = {'$in': list(days)}
+    docs = _get_db().tick_digests.find(query, {'_id': False, 'day': True, 'count': True, 'checksum': True})
+    return {doc['day']: (doc['count'], doc['checksum']) for doc in docs}
+
+
+def remove_digests(stocks):
+    _get_db().tick_digests.delete_many({'$or': [
+        {'symbol': {'$in': stocks}},
+        {'isin': {'$in': stocks}},
+    ]})
+
+
+def _digests(ticks):
+    """
+    Yields (day, count, checksum) of time ordered (time, price, volume) ticks.
+    """
+    return _numbered_digests(_numbered(ticks))
+
+
+def _numbered_digests(ticks):
+    for day, day_ticks in groupby(ticks, lambda tick: to_timestamp(tick[0]) // DAY):
+        count = checksum = 0
+        for dt, seq, price, volume in day_ticks:
+            count += 1
+            checksum ^= _tick_hash(to_timestamp(dt), seq, price, volume)
+        yield from_timestamp(day * DAY), count, checksum
+
+
+def _tick_hash(t, seq, price, volume):
+    digest = hashlib.blake2b(DIGEST_TICK.pack(t, seq, price, volume), digest_size=8).digest()
+    # Signed to fit into BSON int64
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+def _save_digests(symbol, isin, digests, relative=False):
+    collection = _get_db().tick_digests
+    old = find_digests(symbol, days=digests) if relative else {}
+    updates = []
+    for day, (count, checksum) in digests.items():
+        if relative:
+            old_count, old_checksum = old.get(day, (0, 0))
+            count, checksum = old_count + count, old_checksum ^ checksum
+        doc = {'symbol': symbol, 'isin': isin, 'day': day, 'count': count, 'checksum': checksum}
+        updates.append(pymongo.ReplaceOne({'symbol': symbol, 'day': day}, doc, upsert=True))
+    collection.bulk_write(updates, ordered=False)
+
+
+# Local tick cache
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _get_cache():
+    """
+    Returns process wide tick cache if SIX_SCRAPER_CACHE_DIR is set, None otherwise.
+    """
+    global _cache
+    path = os.environ.get('SIX_SCRAPER_CACHE_DIR')
+    if not path:
+        return None
+    with _cache_lock:
+        if _cache is None or _cache.path != path:
+            max_size = float(os.environ.get('SIX_SCRAPER_CACHE_SIZE', 1024)) * 1024 * 1024
+            _cache = TickCache(path, max_size=max_size)
+    return _cache
+
+
+def find_ticks(symbol, from_=None, to=None):
+    """
+    Yields (time, price, volume) ticks of a stock, reading closed days through cache if there is one.
+    """
+    cache = _get_cache()
+    if cache is None:
+        return _get_store().find(symbol, from_=from_, to=to)
+    return cache.find(_get_store(), symbol, from_=from_, to=to)
+
+
+def find_columns(symbol, from_=None, to=None):
+    """
+    Same as find_ticks(), but returns MarketData without isin, built without
+    going through tick tuples where storage or cache allow.
+    """
+    cache = _get_cache()
+    if cache is None:
+        return _get_store().find_columns(symbol, from_=from_, to=to)
+    return cache.find_columns(_get_store(), symbol, from_=from_, to=to)
+
+
+class TickCache:
+    """
+    Keeps ticks of closed trading days in binary files, a file per symbol and day,
+    which are memory-mapped when read. Least recently used files are evicted
+    once cache grows over max_size bytes.
+
+    File names carry the day digest from tick_digests the file was read against,
+    so days changed by writers without the cache are read from database again,
+    outdated files are left to eviction.
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+
+    def find(self, store, symbol, from_=None, to=None):
+        closed, open_from = self._closed(store, symbol, from_, to)
+        for data in closed:
+            yield from data
+        if open_from:
+            yield from store.find(symbol, from_=open_from, to=to)
+
+    def find_columns(self, store, symbol, from_=None, to=None):
+        closed, open_from = self._closed(store, symbol, from_, to)
+        parts = list(closed)
+        if open_from:
+            parts.append(store.find_columns(symbol, from_=open_from, to=to))
+        return MarketData.concat(symbol, None, parts)
+
+    def _closed(self, store, symbol, from_=None, to=None):
+        """
+        Returns cached day slices within range and time to read the rest from database,
+        which is None if there is nothing left.
+        """
+        today = datetime.datetime.combine(_six_today(), datetime.time())
+        if from_ is None:
+            first_tick = first(store.find(symbol, to=to))
+            from_ = first_tick[0] if first_tick else today
+        # Only closed days up to the last stored tick are cached
+        last_time = store.last_time(symbol)
+        end_day = min(today, last_time + datetime.timedelta(days=1)) if last_time else today
+        if to:
+            end_day = min(end_day, to + datetime.timedelta(days=1))
+        end_day = max(end_day.date(), from_.date())
+
+        closed = (
+            data.slice(start=max(datetime.datetime.combine(day, datetime.time()), from_), end=to)
+            for day, data in self._segments(store, symbol, from_.date(), end_day)
+        )
+        # Open day and anything after last stored tick is read from database
+        open_from = max(from_, datetime.datetime.combine(end_day, datetime.time()))
+        return closed, open_from if not to or open_from <= to else None
+
+    def _segments(self, store, symbol, first_day, end_day):
+        """
+        Yields (day, data) for days in [first_day, end_day),
+        reading each run of missing ones with a single query.
+        """
+        days = [first_day + datetime.timedelta(days=i) for i in range((end_day - first_day).days)]
+        digests = find_digests(symbol, [datetime.datetime.combine(day, datetime.time()) for day in days])
+        digests = {day.date(): digest for day, digest in digests.items()}
+
+        missing = []
+        for day in days:
+            data = self.get(symbol, day, digests.get(day))
+            if data is None:
+                missing.append(day)
+            else:
+                yield from self._fill(store, symbol, missing, digests)
+                missing = []
+                yield day, data
+        yield from self._fill(store, symbol, missing, digests)
+
+    def _fill(self, store, symbol, days, digests):
+        if not days:
+            return
+        start = datetime.datetime.combine(days[0], datetime.time())
+        end = datetime.datetime.combine(days[-1], datetime.time()) + datetime.timedelta(days=1) - SECOND
+        groups = groupby(store.find(symbol, from_=start, to=end), lambda tick: tick[0].date())
+        tick_day, group = next(groups, (None, None))
+        for day in days:
+            # Days with no trades are cached too, as empty files
+            data = MarketData(symbol, None, group if tick_day == day else ())
+            if tick_day == day:
+                tick_day, group = next(groups, (None, None))
+            self.put(symbol, day, data, digests.get(day))
+            yield day, data
+        self.evict()
+
+    def get(self, symbol, day, digest=None):
+        filename = self._filename(symbol, day, digest)
+        try:
+            with open(filename, 'rb') as f:
+                data = _read_binary(f)
+            os.utime(filename)
+        except (FileNotFoundError, BrokenFile):
+            self._count(misses=1)
+            return None
+        self._count(hits=1)
+        return data
+
+    def put(self, symbol, day, data, digest=None):
+        filename = self._filename(symbol, day, digest)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+        with open(tmp_filename, 'wb') as f:
+            _write_binary(f, data)
+        os.replace(tmp_filename, filename)
+
+    def invalidate(self, symbol, since=None):
+        """
+        Removes cached days of a stock, only ones from since on if given.
+        """
+        directory = os.path.join(self.path, symbol)
+        since = since and since.date().isoformat()
+        for name in silent(os.listdir)(directory) or ():
+            if not since or name[:len(since)] >= since:
+                with suppress(FileNotFoundError):
+                    os.remove(os.path.join(directory, name))
+
+    def evict(self):
+        files = []
+        for directory, _, names in os.walk(self.path):
+            for name in names:
+                with suppress(FileNotFoundError):
+                    stat = os.stat(os.path.join(directory, name))
+                    files.append((stat.st_mtime, stat.st_size, os.path.join(directory, name)))
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, filename in sorted(files):
+            if size <= self.max_size:
+                break
+            with suppress(FileNotFoundError):
+                os.remove(filename)
+            size -= file_size
+
+    def report(self):
+        if self.hits or self.misses:
+            _warn("Tick cache: %d hits, %d misses." % (self.hits, self.misses))
+
+    def _count(self, hits=0, misses=0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def _filename(self, symbol, day, digest=None):
+        """Days without digest are ones with no ticks or saved before digests were kept."""
+        count, checksum = digest or (0, 0)
+        name = '%s.%d-%x.bin' % (day.isoformat(), count, checksum & 0xffffffffffffffff)
+        return os.path.join(self.path, symbol, name)
+
+
+def _six_today():
+    return datetime.datetime.now(ZoneInfo(SIX_TIMEZONE)).date()
+
+
+# Database commands
+
+def do_list():
+    records = _get_resolver().all()
+    for stock in records:
+        print("%(symbol)s\t%(isin)s" % stock)
+    if not records:
+        _warn("Update list is empty")
+
+
+def do_add(symbol_or_isin):
+    db = _get_db()
+
+    if find_stock(symbol_or_isin):
+        _exit("Stock %s is already in update list." % symbol_or_isin)
+
+    # Grab data
+    # NOTE: we have 2 resong to grab before saving to database:
+    #           - validate symbol/isin
+    #           - get corresponding symbol/isin
+    data = grab(symbol_or_isin)
+    save_data_to_db(data)
+
+    # Add to update list
+    db.stocks.insert_one({'symbol': data.symbol, 'isin': data.isin})
+    _get_resolver().invalidate()
+    print("Stock %s added to update list." % symbol_or_isin)
+
+
+def do_remove(stocks, purge_data=False):
+    db = _get_db()
+    query = {'$or': [
+        {'symbol': {'$in': stocks}},
+        {'isin': {'$in': stocks}},
+    ]}
+
+    # Resolve and remove
+    records = _get_resolver().find_many(stocks)
+    if records:
+        db.stocks.delete_many(query)
+        _get_resolver().invalidate()
+        print("Stocks %s removed from update list." % ', '.join(pluck('symbol', records)))
+
+    # Check of all listed stocks were found
+    found = set(cat((r['symbol'], r['isin']) for r in records))
+    not_found = lremove(found, stocks)
+    if not_found:
+        _warn("Stocks %s are not on update list." % ', '.join(not_found))
+
+    # Purge data
+    if purge_data:
+        # Forget HTTP validators, so that next update grabs data in full
+        ids = set(stocks) | found
+        db.http_cache.delete_many({'_id': {'$in': list(ids)}})
+
+        remove_rollups(stocks)
+        remove_digests(stocks)
+        cache = _get_cache()
+        if cache:
+            for symbol in set(stocks) | set(pluck('symbol', records)):
+                cache.invalidate(symbol)
+        if _get_store().remove(stocks):
+            print("Stocks %s data erased." % ', '.join(stocks))
+        else:
+            _warn("No data for %s to erase." % ', '.join(stocks))
+
+
+def do_update(stocks, workers=1, batch_size=INSERT_BATCH_SIZE):
+    if not stocks:
+        stocks = [stock['symbol'] for stock in _get_resolver().all()]
+
+    start = time.monotonic()
+    if workers > 1:
+        results = _process_stocks_concurrently(_do_update, stocks, batch_size, workers=workers)
+    else:
+        results = _process_stocks(_do_update, stocks, batch_size)
+    _report_throughput(sum(inserted for inserted, _ in results), time.monotonic() - start)
+
+
+# Stored ticks this far back from the last one are compared with downloaded ones
+MERGE_WINDOW = datetime.timedelta(seconds=float(os.environ.get('SIX_SCRAPER_MERGE_WINDOW', 300)))
+
+
+def _merge_since(last_time):
+    return last_time - MERGE_WINDOW if last_time else None
+
+
+def _do_update(stock, batch_size=INSERT_BATCH_SIZE, last_time=None):
+    """
+    Returns number of inserted ticks and time of the last stored one.
+    Passing last stored tick time if it's known saves a database query.
+    """
+    print("Updating %s..." % stock)
+    symbol = stock
+    try:
+        # Ticks are stored by symbol, while stock could be given by isin
+        symbol = (find_stock(stock) or {}).get('symbol', stock)
+        if last_time is None:
+            with METRICS.timer('last_time'):
+                last_time = _get_store().last_time(symbol)
+        data, save_validators = grab_if_modified(stock, since=_merge_since(last_time), symbol=symbol)
+        if data is None:
+            return 0, last_time
+
+        inserted = save_data_to_db(data, batch_size=batch_size, last_time=last_time)
+        save_validators()
+        return inserted, from_timestamp(data.times[-1]) if len(data) else last_time
+    except (SystemExit, Exception):
+        METRICS.count('failures', symbol=symbol)
+        raise
+
+
+def _report_throughput(inserted, elapsed, what=None):
+    message = "Inserted %d ticks in %.1fs, %d ticks/s." % (inserted, elapsed, inserted / (elapsed or 1))
+    print("%s: %s" % (what, message) if what else message)
+
+
+def do_watch(stocks, interval=60, max_interval=900, workers=1, batch_size=INSERT_BATCH_SIZE):
+    # Make output visible in logs right away when running as a service
+    sys.stdout.reconfigure(line_buffering=True)
+
+    watcher = Watcher(stocks, interval=interval, max_interval=max_interval,
+                      workers=workers, batch_size=batch_size)
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+    signal.signal(signal.SIGHUP, lambda signum, frame: watcher.reload())
+    watcher.run()
+
+
+class Watcher:
+    """
+    Polls stocks keeping process, connections and last seen tick times alive between polls.
+
+    Each stock is polled on its own schedule: more often while it gets new ticks,
+    up to once an interval, and backing off to max interval when it doesn't.
+    Outside of SIX trading hours it sleeps until market opens.
+    """
+    def __init__(self, stocks, interval=60, max_interval=900, workers=1, batch_size=INSERT_BATCH_SIZE):
+        self.stocks = stocks
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.workers = workers
+        self.batch_size = batch_size
+
+        self.schedule = {}      # stock -> (next poll time, current interval)
+        self.last_times = {}    # stock -> last stored tick time
+        self._stopped = threading.Event()
+        self._wakeup = threading.Event()
+        self._reload = True
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def reload(self):
+        self._reload = True
+        self._wakeup.set()
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self._stopped.is_set():
+                if self._reload:
+                    self._load_stocks()
+
+                next_open = _next_open(datetime.datetime.now(datetime.timezone.utc))
+                if next_open:
+                    print("Market is closed, sleeping until %s." % next_open)
+                    # Start polling all stocks anew at random times within first interval
+                    self.schedule = {stock: (next_open.timestamp() + random.uniform(0, self.interval),
+                                             self.interval) for stock in self.schedule}
+                    self._sleep_until(next_open.timestamp())
+                    continue
+
+                now = time.time()
+                due = [stock for stock, (at, _) in self.schedule.items() if at <= now]
+                list(executor.map(self.poll, due))
+
+                if self.schedule:
+                    self._sleep_until(min(at for at, _ in self.schedule.values()))
+                else:
+                    self._sleep_until(time.time() + self.max_interval)
+        print("Stopped.")
+
+    def _sleep_until(self, timestamp):
+        # Stop and reload wake the loop up early
+        self._wakeup.wait(max(0, timestamp - time.time()))
+        self._wakeup.clear()
+
+    def _load_stocks(self):
+        self._reload = False
+        _get_resolver().invalidate()
+        stocks = self.stocks or [stock['symbol'] for stock in _get_resolver().all()]
+        now = time.time()
+        self.schedule = {stock: self.schedule.get(stock, (now, self.interval)) for stock in stocks}
+        if not stocks:
+            _warn("Update list is empty")
+
+    def poll(self, stock):
+        inserted = 0
+        try:
+            inserted, self.last_times[stock] = _do_update(stock, batch_size=self.batch_size,
+                                                          last_time=self.last_times.get(stock))
+        except SystemExit:
+            # Failed stock is tried again later as if it had no new ticks
+            pass
+        except Exception as e:
+            # Unexpected pages from SIX or database hiccups must not stop the daemon
+            _warn("Failed to update %s: %s" % (stock, e))
+        self._reschedule(stock, inserted)
+
+    def _reschedule(self, stock, inserted):
+        _, interval = self.schedule.get(stock, (None, self.interval))
+        if inserted:
+            interval = max(self.interval, interval / 2)
+        else:
+            interval = min(self.max_interval, interval * 1.5)
+        # Jitter spreads polls of different stocks over time
+        self.schedule[stock] = (time.time() + interval * random.uniform(0.9, 1.1), interval)
+
+
+# SIX trading hours with a few minutes for closing auction trades to come in
+SIX_TIMEZONE = 'Europe/Zurich'
+SIX_OPEN = datetime.time(9, 0)
+SIX_CLOSE = datetime.time(17, 35)
+
+
+def _next_open(now):
+    """
+    Returns None if SIX is open at given aware datetime, next opening time otherwise.
+    Exchange holidays are not accounted for.
+    """
+    tz = ZoneInfo(SIX_TIMEZONE)
+    local = now.astimezone(tz)
+    if local.weekday() < 5 and SIX_OPEN <= local.time() < SIX_CLOSE:
+        return None
+
+    day = local.date()
+    if local.weekday() >= 5 or local.time() >= SIX_CLOSE:
+        day += datetime.timedelta(days=1)
+    while day.weekday() >= 5:
+        day += datetime.timedelta(days=1)
+    return datetime.datetime.combine(day, SIX_OPEN, tzinfo=tz)
+
+
+# Other commands
+
+def do_grab(symbol_or_isin, options=None):
+    data = grab(symbol_or_isin)
+    save_data(data, **options)
+
+
+def do_export(stocks, from_=None, to=None, workers=1, combined=False, resample=None,
+              rollups=False, options=None):
+    """
+    Exports several stocks at once, finding them all with a single query.
+    Ticks are read with a single cursor too, unless there are several workers
+    or local tick cache is configured, then stocks are exported one by one.
+    """
+    if resample and (combined or options['mode'] == 'append' or options['format'] == 'bin'):
+        _exit("Resampled export could not be combined, appended or written in binary format.")
+    if rollups and not resample:
+        _exit("Reading rollups requires --resample.")
+
+    records = sorted(find_stocks(stocks), key=itemgetter('symbol'))
+    symbols = [stock['symbol'] for stock in records]
+    store = _get_store()
+
+    if rollups:
+        for stock in records:
+            bars = find_bars(stock['symbol'], resample, from_=from_, to=to)
+            with suppress(SystemExit):
+                save_data(Bars(stock['symbol'], stock['isin'], bars), **options)
+    elif combined:
+        if options['mode'] == 'append' or options['format'] == 'bin':
+            _exit("Combined export could not be appended or written in binary format.")
+        data = CombinedTicks(store.find_many(symbols, from_=from_, to=to))
+        filename = options['filename'] or _default_filename('export', options['format'], options.get('compress'))
+        save_data(data, **dict(options, filename=filename))
+    elif workers > 1:
+        _process_stocks_concurrently(_export_stock, records, from_, to, resample,
+                                     options=options, workers=workers)
+    elif _get_cache():
+        # Cache is per stock, so there is no point in a single cursor
+        _process_stocks(_export_stock, records, from_, to, resample, options=options)
+    else:
+        # Fan out ticks ordered by symbol to each stock file
+        groups = groupby(store.find_many(symbols, from_=from_, to=to), itemgetter(0))
+        symbol, group = next(groups, (None, None))
+        for stock in records:
+            has_ticks = stock['symbol'] == symbol
+            ticks = (tick[1:] for tick in group) if has_ticks else ()
+            with suppress(SystemExit):
+                save_data(_export_data(stock, ticks, resample), **options)
+            if has_ticks:
+                symbol, group = next(groups, (None, None))
+
+    cache = _get_cache()
+    if cache:
+        cache.report()
+
+
+def _export_stock(stock, from_=None, to=None, resample=None, options=None):
+    ticks = find_ticks(stock['symbol'], from_=from_, to=to)
+    save_data(_export_data(stock, ticks, resample), **options)
+
+
+def _export_data(stock, ticks, resample=None):
+    if resample:
+        return Bars.from_ticks(stock['symbol'], stock['isin'], ticks, resample)
+    return TickStream(stock['symbol'], stock['isin'], ticks)
+
+
+STATS_PERIODS = {'day': DAY, 'hour': 60 * 60}
+
+
+def do_stats(stocks=None, from_=None, to=None, by='day', options=None):
+    """
+    Writes stats of given stocks, all ones by default, per day or hour into a single file.
+    Ticks are read as columns and aggregated with numpy if it is installed.
+    """
+    if by not in STATS_PERIODS:
+        _exit("Stats could be computed by %s." % ' or '.join(STATS_PERIODS))
+    if options['mode'] == 'append' or options['format'] == 'bin':
+        _exit("Stats could not be appended or written in binary format.")
+
+    records = find_stocks(stocks) if stocks else _get_resolver().all()
+    rows = (
+        (stock['symbol'],) + row
+        for stock in sorted(records, key=itemgetter('symbol'))
+        for row in tick_stats(find_columns(stock['symbol'], from_=from_, to=to), STATS_PERIODS[by])
+    )
+    filename = options['filename'] or _default_filename('stats', options['format'], options.get('compress'))
+    save_data(Stats(rows), **dict(options, filename=filename))
+
+    cache = _get_cache()
+    if cache:
+        cache.report()
+
+
+def do_load(paths, symbol_or_isin=None, workers=1, batch_size=INSERT_BATCH_SIZE, options=None):
+    """
+    Loads files, globs or directories of them into database.
+    Files are parsed by worker processes if there are several workers,
+    parsed data is passed through a bounded queue to a single inserting thread.
+    """
+    filenames = _expand_paths(paths, format=options['format'])
+    single = len(filenames) == 1
+    parsed = queue.Queue(maxsize=workers)
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        inserting = executor.submit(_insert_parsed, parsed, symbol_or_isin, batch_size=batch_size,
+                                    progress=_show_progress if single else None, report=not single)
+        try:
+            for item in _parse_files(filenames, format=options['format'], workers=workers):
+                parsed.put(item)
+        finally:
+            parsed.put(None)
+        inserted, failed = inserting.result()
+    _report_throughput(inserted, time.monotonic() - start)
+
+    if failed:
+        _exit("Failed to load %d of %d files." % (failed, len(filenames)))
+
+
+def _insert_parsed(parsed, symbol_or_isin=None, batch_size=INSERT_BATCH_SIZE, progress=None, report=False):
+    """
+    Saves (filename, data) items from queue until None comes,
+    returns number of inserted ticks and failed files.
+
+    After an error queue is still drained, so that parsing side doesn't block on it,
+    and then error is re-raised.
+    """
+    inserted = failed = 0
+    error = None
+    while True:
+        item = parsed.get()
+        if item is None:
+            break
+        filename, data = item
+        if error:
+            continue
+
+        try:
+            count = None
+            with suppress(SystemExit):
+                if data is not None:
+                    count = _insert_file(filename, data, symbol_or_isin, batch_size, progress, report)
+            if count is None:
+                failed += 1
+            else:
+                inserted += count
+        except Exception as e:
+            error = e
+
+    if error:
+        raise error
+    return inserted, failed
+
+
+def _insert_file(filename, data, symbol_or_isin, batch_size, progress, report):
+    if not data.symbol:
+        _set_stock(data, filename, symbol_or_isin, find_stock(symbol_or_isin or _filename_stem(filename)))
+
+    start = time.monotonic()
+    inserted = save_data_to_db(data, batch_size=batch_size, progress=progress)
+    if report:
+        _report_throughput(inserted, time.monotonic() - start, what=filename)
+    return inserted
+
+
+def _show_progress(processed, total):
+    # Only makes sense on terminal, would clutter logs otherwise
+    if sys.stderr.isatty():
+        end = '\n' if processed == total else ''
+        print("\rProcessed %d of %d ticks..." % (processed, total), end=end, file=sys.stderr, flush=True)
+
+
+def do_convert(filename):
+    try:
+        with open(filename, 'rb') as f:
+            _peek_json(f)
+        print("File %s is already in append friendly layout." % filename)
+        return
+    except FileNotFoundError:
+        _exit("File %s not found." % filename)
+    except LegacyFile:
+        pass
+    except BrokenFile:
+        _exit("File %s format is broken." % filename)
+
+    try:
+        _convert_file(filename)
+    except BrokenFile:
+        _exit("File %s format is broken." % filename)
+    print("File %s converted." % filename)
+
+
+def do_setup():
+    db = _get_db()
+
+    db.stocks.create_index('symbol')
+    db.stocks.create_index('isin')
+    _get_store().setup()
+    for collection, _ in ROLLUPS:
+        db[collection].create_index([('symbol', pymongo.ASCENDING), ('time', pymongo.ASCENDING)],
+                                    unique=True)
+        db[collection].create_index('isin')
+    db.tick_digests.create_index([('symbol', pymongo.ASCENDING), ('day', pymongo.ASCENDING)], unique=True)
+    db.tick_digests.create_index('isin')
+
+
+def do_rebuild_rollups(stocks=None):
+    store = _get_store()
+    records = find_stocks(stocks) if stocks else \
+              [find_stock(symbol) or {'symbol': symbol, 'isin': None} for symbol in store.symbols()]
+    for stock in records:
+        print("Rebuilding rollups for %s..." % stock['symbol'])
+        remove_rollups([stock['symbol']])
+        update_rollups(stock['symbol'], stock['isin'])
+
+
+def do_verify(stocks=None, deep=False, repair=False):
+    """
+    Checks day digests of stocks, all ones by default.
+
+    Cheap check compares digests with daily rollups, not reading ticks at all, and warns about
+    weekdays without ticks. Deep one recomputes digests from ticks, optionally storing them.
+    """
+    if repair and not deep:
+        _exit("Only --deep verification could --repair.")
+
+    records = find_stocks(stocks) if stocks else _get_resolver().all()
+    failed = []
+    for stock in sorted(records, key=itemgetter('symbol')):
+        symbol = stock['symbol']
+        digests = find_digests(symbol)
+        if deep:
+            actual = {day: (count, checksum) for day, count, checksum in _digests(_get_store().find(symbol))}
+            problems = _verify_deep(digests, actual)
+        else:
+            problems = _verify_cheap(digests, _get_db().bars_1d.find({'symbol': symbol}))
+            # Holidays and days nobody traded look the same, so gaps don't fail verification
+            for day in _missing_days(digests):
+                _warn("%s %s: no ticks" % (symbol, day.strftime('%d.%m.%Y')))
+
+        for problem in problems:
+            print("%s %s" % (symbol, problem))
+            if symbol not in failed:
+                failed.append(symbol)
+        if deep and repair and symbol in failed:
+            remove_digests([symbol])
+            if actual:
+                _save_digests(symbol, stock['isin'], actual)
+            print("Digests of %s repaired." % symbol)
+
+    if failed and not repair:
+        _exit("Verification failed for %s." % ', '.join(failed))
+    print("Verified %d stocks." % len(records))
+
+
+def _verify_cheap(digests, daily_bars):
+    counts = {bar['time']: bar['count'] for bar in daily_bars}
+    for day in sorted(set(digests) | set(counts)):
+        count = digests[day][0] if day in digests else 0
+        if count != counts.get(day, 0):
+            yield "%s: %d ticks in digest, %d in daily rollup" % (day.strftime('%d.%m.%Y'), count,
+                                                                   counts.get(day, 0))
+
+
+def _missing_days(digests):
+    """Yields weekdays without ticks between first and last traded day, trading holidays among them."""
+    days = sorted(day for day, (count, _) in digests.items() if count)
+    day = days[0] if days else None
+    while day and day < days[-1]:
+        if day.weekday() < 5 and day not in digests:
+            yield day
+        day += datetime.timedelta(days=1)
+
+
+def _verify_deep(digests, actual):
+    for day in sorted(set(digests) | set(actual)):
+        count, checksum = digests.get(day, (0, 0))
+        actual_count, actual_checksum = actual.get(day, (0, 0))
+        if count != actual_count:
+            yield "%s: %d ticks in digest, %d stored" % (day.strftime('%d.%m.%Y'), count, actual_count)
+        elif checksum != actual_checksum:
+            yield "%s: checksum differs from stored ticks" % day.strftime('%d.%m.%Y')
+
+
+def do_migrate(storage):
+    source, target = _get_store(), _get_store(storage)
+    if type(source) is type(target):
+        _exit("Data is already in %s storage." % storage)
+
+    target.setup()
+    for symbol in source.symbols():
+        print("Migrating %s..." % symbol)
+        stock = find_stock(symbol)
+        data = MarketData(symbol, stock['isin'] if stock else None, source.find(symbol))
+        target.insert(symbol, data.isin, data)
+        source.remove([symbol])
+    print("Done. Set SIX_SCRAPER_STORAGE=%s to use migrated data." % storage)
+
+
+# Main procedure
+
+
+def main():
+    global SIX_THROTTLE
+
+    args = docopt(__doc__)
+    options = {
+        'format': 'csv' if args['--csv'] else
+                  'json' if args['--json'] else
+                  'bin' if args['--binary'] else None,
+        'mode': 'append' if args['--append'] else
+                'overwrite' if args['--overwrite'] else 'strict',
+        'filename': args['-f'],
+        'compress': args['--compress'],
+    }
+    if args['--compress']:
+        _get_codec(args['--compress'])
+    if args['update'] or args['watch']:
+        SIX_THROTTLE = Throttle(
+            rate=_parse_number(args['--rate'], float),
+            max_inflight=_parse_number(args['--max-inflight'], int),
+        )
+
+    profile = None
+    if args['--profile']:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        _run_command(args, options)
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(args['--profile'])
+        if args['--metrics']:
+            _warn(METRICS.summary())
+        if args['--prometheus']:
+            METRICS.write_prometheus(args['--prometheus'])
+
+
+def _run_command(args, options):
+    if args['list']:
+        do_list()
+    elif args['add']:
+        _process_stocks(do_add, args['<symbol-or-isin>'])
+    elif args['remove']:
+        do_remove(args['<symbol-or-isin>'])
+    elif args['purge']:
+        do_remove(args['<symbol-or-isin>'], purge_data=True)
+    elif args['grab']:
+        _process_stocks(do_grab, args['<symbol-or-isin>'], options=options)
+    elif args['update']:
+        do_update(args['<symbol-or-isin>'], workers=_parse_number(args['--workers'], int),
+                  batch_size=_parse_number(args['--batch-size'], int))
+    elif args['watch']:
+        do_watch(args['<symbol-or-isin>'],
+                 interval=_parse_number(args['--interval'], float),
+                 max_interval=_parse_number(args['--max-interval'], float),
+                 workers=_parse_number(args['--workers'], int),
+                 batch_size=_parse_number(args['--batch-size'], int))
+    elif args['export']:
+        from_ = _parse_datetime(args['--from']) if args['--from'] else None
+        to = _parse_datetime(args['--to']) if args['--to'] else None
+        do_export(args['<symbol-or-isin>'], from_=from_, to=to,
+                  workers=_parse_number(args['--workers'], int),
+                  combined=args['--combined'],
+                  resample=_parse_interval(args['--resample']) if args['--resample'] else None,
+                  rollups=args['--rollups'], options=options)
+    elif args['load']:
+        do_load([args['-f']] if args['-f'] else args['<path>'],
+                symbol_or_isin=args['--as'],
+                workers=_parse_number(args['--workers'], int),
+                batch_size=_parse_number(args['--batch-size'], int), options=options)
+    elif args['convert']:
+        do_convert(args['-f'])
+    elif args['setup']:
+        do_setup()
+    elif args['migrate']:
+        do_migrate(args['<storage>'])
+    elif args['stats']:
+        from_ = _parse_datetime(args['--from']) if args['--from'] else None
+        to = _parse_datetime(args['--to']) if args['--to'] else None
+        do_stats(args['<symbol-or-isin>'], from_=from_, to=to, by=args['--by'], options=options)
+    elif args['rebuild-rollups']:
+        do_rebuild_rollups(args['<symbol-or-isin>'])
+    elif args['verify']:
+        do_verify(args['<symbol-or-isin>'], deep=args['--deep'], repair=args['--repair'])
+
+
+def _process_stocks(action, stocks, *args, **kwargs):
+    """
+    Runs action for each stock, returns results of successful ones.
+    """
+    results = []
+    for stock in stocks:
+        # Suppress failed subtask and go to the next one
+        with suppress(SystemExit):
+            results.append(action(stock, *args, **kwargs))
+    return results
+
+
+def _process_stocks_concurrently(action, stocks, *args, workers=1, **kwargs):
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(action, stock, *args, **kwargs) for stock in stocks]
+        for future in as_completed(futures):
+            # Same as above, SystemExit raised in a worker is re-raised here
+            with suppress(SystemExit):
+                results.append(future.result())
+    return results
+
+
+def _parse_number(value, type_):
+    if value is None:
+        return None
+    number = silent(type_)(value)
+    if number is None or number <= 0:
+        _exit("\"%s\" is not a positive number." % value)
+    return number
+
+
+def _parse_interval(interval):
+    try:
+        return parse_interval(interval)
+    except ValueError:
+        _exit("Can't parse \"%s\" into interval, use one like 1min, 5min, 1h or 1d." % interval)
+
+
+def _parse_datetime(dt_str):
+    FORMATS = ['%d.%m.%Y', '%d.%m.%YT%H:%M', '%d.%m.%YT%H:%M:%S',
+                           '%d.%m.%Y %H:%M', '%d.%m.%Y %H:%M:%S']
+    tries = (silent(datetime.datetime.strptime)(dt_str, f) for f in FORMATS)
+    return some(tries) or _exit("Can't parse \"%s\" into datetime." % dt_str)
+
+
+def _exit(message):
+    print(message, file=sys.stderr)
+    sys.exit(1)
+
+def _warn(message):
+    print(message, file=sys.stderr)
+
+
+def run():
+    """
+    Entry point of six-scraper command, reports connection problems without traceback.
+    """
+    try:
+        main()
+    except (KeyboardInterrupt, SystemExit) as e:
+        # Matching errors below would import requests and pymongo needlessly
+        if isinstance(e, SystemExit):
+            raise
+    # Database goes first since most commands don't use requests
+    except pymongo.errors.ConnectionFailure:
+        _exit('Problem with database connection. Terminating...')
+    except requests.HTTPError as e:
+        _exit('HTTP error: %s. Terminating...' % e.reason)
+    except (requests.Timeout, requests.ConnectionError) as e:
+        _exit('Failed to connect to %s. Terminating...' % e.request.url)
+
+
+if __name__ == '__main__':
+    run()
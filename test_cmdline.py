@@ -40,25 +40,25 @@ def env():
 
 @pytest.yield_fixture
 def db():
-    conn = pymongo.Connection()
+    conn = pymongo.MongoClient()
     conn.drop_database(DB_NAME) # start afresh
     yield conn[DB_NAME]
     conn.drop_database(DB_NAME)
 
 @pytest.fixture
 def stocks(db):
-    db.stocks.insert(copy.deepcopy(STOCKS))
+    db.stocks.insert_many(copy.deepcopy(STOCKS))
 
 @pytest.fixture
 def ticks(db):
-    db.ticks.insert(copy.deepcopy(TICKS))
+    db.ticks.insert_many(copy.deepcopy(TICKS))
 
 
 def _list_stocks(db):
-    return list(db.stocks.find(fields={'_id': False}))
+    return list(db.stocks.find({}, {'_id': False}))
 
 def _list_ticks(db):
-    return list(db.ticks.find(fields={'_id': False}))
+    return list(db.ticks.find({}, {'_id': False}))
 
 def _json_res(result, symbol):
     filename = symbol + '.json'
@@ -149,11 +149,11 @@ def test_load_json(env, db):
     }).encode('utf-8'))
     env.run(COMMAND, 'load', '-f', 'ABBN.json')
     assert _list_ticks(db) == [{'isin': 'CH0012221716', 'symbol': 'ABBN',
-        'time': datetime.datetime(2014, 7, 30, 15, 5, 20), 'price': 5.5, 'volume': 1230}]
+        'time': datetime.datetime(2014, 7, 30, 15, 5, 20), 'seq': 0, 'price': 5.5, 'volume': 1230}]
 
 
 def test_load_csv(env, db, stocks):
     env.writefile('some.csv', b'30.07.2014 15:05:20;5.5;1230\n')
     env.run(COMMAND, 'load', '-f', 'some.csv', '--as', 'ATLN')
     assert _list_ticks(db) == [{'isin': 'CH0010532478', 'symbol': 'ATLN',
-        'time': datetime.datetime(2014, 7, 30, 15, 5, 20), 'price': 5.5, 'volume': 1230}]
+        'time': datetime.datetime(2014, 7, 30, 15, 5, 20), 'seq': 0, 'price': 5.5, 'volume': 1230}]
@@ -1,15 +1,19 @@
 import os
 import io
+import time
 import datetime
+import math
 import json
+import gzip
+import pickle
+import threading
 
 import pytest
 import mongomock
 import pymongo
+import requests
 
-
-# NOTE: Can't do normal import since name contains hyphen.
-script = __import__('six-scraper')
+import six_scraper as script
 
 
 # Test data, utilities and fixtures
@@ -40,12 +44,44 @@ class capture:
 
 @pytest.yield_fixture()
 def mock_db():
-    db = mongomock.Connection().smi
+    db = mongomock.MongoClient().smi
 
     real = script._get_db
     script._get_db = lambda: db
+    script._resolver = None
     yield db
     script._get_db = real
+    script._resolver = None
+
+
+class FakeSession:
+    """Imitates six-swiss-exchange.com honoring conditional requests."""
+    def __init__(self, text, etag='"v1"'):
+        self.text = text
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        self.requests.append(headers or {})
+        response = requests.Response()
+        response.url = url
+        response.headers['ETag'] = self.etag
+        if (headers or {}).get('If-None-Match') == self.etag:
+            response.status_code = 304
+        else:
+            response.status_code = 200
+            response._content = self.text.encode('utf-8')
+        return response
+
+
+@pytest.yield_fixture()
+def fake_session():
+    session = FakeSession(RAW_DATA)
+
+    real = script._session
+    script._session = session
+    yield session
+    script._session = real
 
 
 # Parse/grab tests
@@ -59,6 +95,252 @@ def test_parse():
     assert data.data == DATA.data
 
 
+def test_parse_since():
+    def parse(since):
+        return script._parse_raw(RAW_DATA, since=since)[2]
+
+    assert parse(datetime.datetime(2014, 7, 29, 15, 24, 35)) == DATA.data[1:]
+    assert parse(datetime.datetime(2014, 7, 29, 15, 23, 3)) == DATA.data
+    assert parse(datetime.datetime(2014, 7, 29, 15, 25)) == []
+    assert parse(datetime.datetime(2014, 7, 28, 17, 30)) == DATA.data
+    assert parse(datetime.datetime(2014, 7, 30, 9, 0)) == []
+
+
+def test_market_data_columns():
+    assert list(DATA.times) == [1406647383, 1406647475]
+    assert list(DATA.prices) == [21.52, 21.6]
+    assert list(DATA.volumes) == [5738, 9010]
+    assert len(DATA) == 2
+    assert list(DATA) == DATA.data
+
+
+def test_market_data_from_rows_unsorted():
+    rows = [('29.07.2014 15:24:35', '21.6', '9010'), ('29.07.2014 15:23:03', '21.52', '5738'),
+            ('29.07.2014 15:24:35', '21.7', '1')]
+    data = script.MarketData.from_rows('ABBN', 'CH0012221716', rows)
+    assert data.data == DATA.data + [(DATA.data[1][0], 21.7, 1)]
+
+
+def test_market_data_slice():
+    first, second = [dt for dt, _, _ in DATA]
+    assert DATA.slice().data == DATA.data
+    assert DATA.slice(start=second).data == DATA.data[1:]
+    assert DATA.slice(end=first).data == DATA.data[:1]
+    assert DATA.slice(start=first + script.SECOND, end=second - script.SECOND).data == []
+
+    # Slice shares memory with original data
+    sliced = DATA.slice(start=second)
+    assert sliced.symbol == DATA.symbol
+    assert sliced.prices.obj is DATA.prices
+
+
+def test_parse_datetime():
+    assert script.parse_datetime('29.07.2014 15:24:35') == datetime.datetime(2014, 7, 29, 15, 24, 35)
+    # Falls back to strptime() for anything not fixed width
+    assert script.parse_datetime('1.7.2014 15:24:35') == datetime.datetime(2014, 7, 1, 15, 24, 35)
+
+    for wrong in ['2014-07-29 15:24:35', '29.07.2014 15-24-35', '32.07.2014 15:24:35', '']:
+        with pytest.raises(ValueError):
+            script.parse_datetime(wrong)
+
+
+def test_backoff():
+    assert 0.25 <= script._backoff(0) <= 0.75
+    assert 1 <= script._backoff(2) <= 3
+
+
+def test_throttle_rate():
+    throttle = script.Throttle(rate=50)
+    start = time.monotonic()
+    for _ in range(5):
+        with throttle:
+            pass
+    # First request goes immediately, then one every 1/50 of a second
+    assert time.monotonic() - start >= 4 / 50
+
+
+def test_process_stocks_concurrently():
+    done = []
+
+    def action(stock):
+        if stock == 'XXXX':
+            script._exit("Security XXXX is not found.")
+        done.append(stock)
+
+    script._process_stocks_concurrently(action, ['ABBN', 'XXXX', 'ATLN'], workers=2)
+    assert sorted(done) == ['ABBN', 'ATLN']
+
+
+def test_next_open():
+    tz = script.ZoneInfo('Europe/Zurich')
+    friday_open = datetime.datetime(2014, 8, 1, 9, 0, tzinfo=tz)
+    monday_open = datetime.datetime(2014, 8, 4, 9, 0, tzinfo=tz)
+
+    assert script._next_open(datetime.datetime(2014, 8, 1, 12, 0, tzinfo=tz)) is None
+    assert script._next_open(datetime.datetime(2014, 8, 1, 7, 0, tzinfo=tz)) == friday_open
+    assert script._next_open(datetime.datetime(2014, 8, 1, 18, 0, tzinfo=tz)) == monday_open
+    assert script._next_open(datetime.datetime(2014, 8, 2, 12, 0, tzinfo=tz)) == monday_open
+    # Works with any timezone
+    utc = datetime.datetime(2014, 8, 1, 6, 0, tzinfo=datetime.timezone.utc)
+    assert script._next_open(utc) == friday_open
+
+
+def test_watcher_adapts_interval():
+    watcher = script.Watcher(['ABBN'], interval=60, max_interval=900)
+    watcher._reschedule('ABBN', inserted=0)
+    assert watcher.schedule['ABBN'][1] == 90
+    for _ in range(10):
+        watcher._reschedule('ABBN', inserted=0)
+    assert watcher.schedule['ABBN'][1] == 900
+
+    watcher._reschedule('ABBN', inserted=10)
+    assert watcher.schedule['ABBN'][1] == 450
+    for _ in range(10):
+        watcher._reschedule('ABBN', inserted=10)
+    assert watcher.schedule['ABBN'][1] == 60
+    assert watcher.schedule['ABBN'][0] <= time.time() + 66
+
+
+def test_watcher_poll(mock_db, fake_session):
+    watcher = script.Watcher(['ABBN'])
+    watcher.poll('ABBN')
+    assert mock_db.ticks.count_documents({}) == 2
+    assert watcher.last_times['ABBN'] == DATA.data[-1][0]
+    assert watcher.schedule['ABBN'][1] == 60
+
+
+def test_watcher_survives_broken_page(mock_db, fake_session, monkeypatch):
+    metrics = script.Metrics()
+    monkeypatch.setattr(script, 'METRICS', metrics)
+    monkeypatch.setattr(script, '_next_open', lambda now: None)
+    fake_session.text = "<html><body>Maintenance</body></html>"
+
+    watcher = script.Watcher(['ABBN', 'NESN'])
+    rounds = []
+    def sleep_until(timestamp):
+        rounds.append(timestamp)
+        if len(rounds) == 2:
+            watcher.stop()
+        else:
+            # Poll again right away
+            watcher.schedule = {stock: (0, interval) for stock, (_, interval) in watcher.schedule.items()}
+    watcher._sleep_until = sleep_until
+    watcher.run()
+
+    assert len(rounds) == 2
+    assert metrics.counters['failures', 'ABBN'] == 2
+    assert metrics.counters['failures', 'NESN'] == 2
+    assert watcher.schedule['ABBN'][1] == 135
+
+
+def test_watcher_reload_wakes_up():
+    watcher = script.Watcher(['ABBN'])
+    timer = threading.Timer(0.1, watcher.reload)
+    timer.start()
+    start = time.monotonic()
+    watcher._sleep_until(time.time() + 60)
+    assert time.monotonic() - start < 10
+    assert watcher._reload
+    timer.join()
+
+
+def test_watcher_poll_isin(mock_db, fake_session, monkeypatch):
+    metrics = script.Metrics()
+    monkeypatch.setattr(script, 'METRICS', metrics)
+    monkeypatch.setattr(script, 'MERGE_WINDOW', datetime.timedelta(0))
+    mock_db.stocks.insert_one({'symbol': DATA.symbol, 'isin': DATA.isin})
+    script.save_data_to_db(DATA)
+
+    # Stored ticks are found by symbol, so older ones are not parsed again
+    watcher = script.Watcher([DATA.isin])
+    watcher.poll(DATA.isin)
+    assert watcher.last_times[DATA.isin] == DATA.data[-1][0]
+    assert metrics.counters['ticks_fetched', 'ABBN'] == 1
+    assert mock_db.ticks.count_documents({}) == 2
+
+
+def test_metrics():
+    metrics = script.Metrics()
+    metrics.observe('http', 0.2)
+    metrics.observe('http', 3)
+    metrics.count('ticks_inserted', 2, symbol='ABBN')
+    metrics.count('retries')
+
+    summary = metrics.summary()
+    assert 'http' in summary and 'ticks_inserted' in summary and 'ABBN' in summary
+
+    text = metrics.prometheus()
+    assert 'six_scraper_phase_seconds_bucket{phase="http",le="0.25"} 1\n' in text
+    assert 'six_scraper_phase_seconds_bucket{phase="http",le="+Inf"} 2\n' in text
+    assert 'six_scraper_phase_seconds_count{phase="http"} 2\n' in text
+    assert 'six_scraper_ticks_inserted_total{symbol="ABBN"} 2\n' in text
+    assert 'six_scraper_retries_total 1\n' in text
+
+
+def test_update_metrics(mock_db, fake_session, monkeypatch):
+    metrics = script.Metrics()
+    monkeypatch.setattr(script, 'METRICS', metrics)
+    script._do_update('ABBN')
+    script._do_update('ABBN')
+
+    assert metrics.counters['ticks_fetched', 'ABBN'] == 2
+    assert metrics.counters['ticks_inserted', 'ABBN'] == 2
+    assert metrics.counters['http_requests', 'ABBN'] == 2
+    assert metrics.counters['not_modified', 'ABBN'] == 1
+    assert metrics.counters['bytes_downloaded', 'ABBN'] == len(RAW_DATA.encode('utf-8'))
+    assert {'http', 'parse', 'last_time', 'insert'} <= set(metrics.timings)
+
+
+def test_update_metrics_by_isin(mock_db, fake_session, monkeypatch):
+    metrics = script.Metrics()
+    monkeypatch.setattr(script, 'METRICS', metrics)
+    monkeypatch.setattr(script.time, 'sleep', lambda seconds: None)
+    mock_db.stocks.insert_one({'symbol': DATA.symbol, 'isin': DATA.isin})
+
+    # First request fails and is retried
+    get = fake_session.get
+    fails = [requests.ConnectionError()]
+    def flaky_get(*args, **kwargs):
+        if fails:
+            raise fails.pop()
+        return get(*args, **kwargs)
+    monkeypatch.setattr(fake_session, 'get', flaky_get)
+    script._do_update(DATA.isin)
+
+    # All metrics are labeled with symbol
+    assert {symbol for _, symbol in metrics.counters} == {'ABBN'}
+    assert metrics.counters['retries', 'ABBN'] == 1
+    assert metrics.counters['http_requests', 'ABBN'] == 1
+    assert metrics.counters['ticks_fetched', 'ABBN'] == 2
+
+
+def test_bars():
+    t = datetime.datetime(2014, 7, 29, 15, 23, 3)
+    ticks = [
+        (t, 10.0, 100),
+        (t + datetime.timedelta(seconds=20), 12.0, 100),
+        (t + datetime.timedelta(seconds=30), 9.0, 200),
+        (t + datetime.timedelta(minutes=5), 11.0, 50),
+    ]
+    bars = list(script.Bars.from_ticks('ABBN', 'CH0012221716', ticks, 60))
+    assert bars == [
+        (datetime.datetime(2014, 7, 29, 15, 23), 10.0, 12.0, 9.0, 9.0, 400, 10.0, 3),
+        (datetime.datetime(2014, 7, 29, 15, 28), 11.0, 11.0, 11.0, 11.0, 50, 11.0, 1),
+    ]
+    assert list(script.Bars.from_ticks('ABBN', 'CH0012221716', ticks, 24 * 60 * 60))[0][:2] \
+        == (datetime.datetime(2014, 7, 29), 10.0)
+
+
+def test_parse_interval():
+    assert script.parse_interval('1min') == 60
+    assert script.parse_interval('5min') == 300
+    assert script.parse_interval('1h') == 3600
+    assert script.parse_interval('1d') == 86400
+    for wrong in ['0min', '1m', 'h', '1.5h']:
+        with pytest.raises(ValueError):
+            script.parse_interval(wrong)
+
+
 # JSON/CSV tests
 
 def test_write_json():
@@ -73,20 +355,51 @@ def test_write_json():
 
 def test_peek_json():
     with pytest.raises(script.BrokenFile):
-        script._peek_json(io.StringIO(''))
+        script._peek_json(io.BytesIO(b''))
 
-    assert script._peek_json(io.StringIO('{"ticks": []}')) == (script.EPOCH, [])
+    assert script._peek_json(io.BytesIO(b'{"ticks": [\n]}\n')) == (script.EPOCH, 0)
 
     with pytest.raises(script.BrokenFile):
-        WRONG_DATE = '''{"ticks": [["2014-07-29 15:24:35", 21.6, 9010]}'''
-        script._peek_json(io.StringIO(WRONG_DATE))
+        WRONG_DATE = b'''{"ticks": [\n["2014-07-29 15:24:35", 21.6, 9010]\n]}\n'''
+        script._peek_json(io.BytesIO(WRONG_DATE))
 
-    JSON = '''{"ticks": [["29.07.2014 15:24:35", 21.6, 9010],
-                        ["29.07.2014 15:23:03", 21.52, 5738]],
-               "isin": "CH0012221716", "symbol": "ABBN"}'''
-    last_dt, ticks = script._peek_json(io.StringIO(JSON))
-    assert last_dt == datetime.datetime(2014, 7, 29, 15, 23, 3)
-    assert len(ticks) == 2
+    with capture() as c:
+        script._write_json(c.file, DATA)
+    JSON = c.out.encode()
+    last_dt, offset = script._peek_json(io.BytesIO(JSON))
+    assert last_dt == datetime.datetime(2014, 7, 29, 15, 24, 35)
+    assert JSON[offset:] == b'\n]}\n'
+
+    # Files written by older versions are readable, but are not appended in place
+    LEGACY = b'''{"ticks": [["29.07.2014 15:24:35", 21.6, 9010],
+                          ["29.07.2014 15:23:03", 21.52, 5738]],
+                "isin": "CH0012221716", "symbol": "ABBN"}'''
+    with pytest.raises(script.LegacyFile):
+        script._peek_json(io.BytesIO(LEGACY))
+
+
+def test_append_json(tmpdir):
+    filename = str(tmpdir.join('ABBN.json'))
+    script.save_data(DATA.slice(end=DATA.data[0][0]), format='json', filename=filename)
+    script.save_data(DATA, format='json', mode='append', filename=filename)
+
+    with open(filename) as f:
+        assert script._read_json(f).data == DATA.data
+
+
+def test_convert_json(tmpdir, capsys):
+    filename = str(tmpdir.join('ABBN.json'))
+    with open(filename, 'w') as f:
+        json.dump({'symbol': 'ABBN', 'isin': 'CH0012221716',
+                   'ticks': [["29.07.2014 15:23:03", 21.52, 5738]]}, f)
+
+    script.save_data(DATA, format='json', mode='append', filename=filename)
+    # Stdout could be exported data, so conversion is reported to stderr
+    out, err = capsys.readouterr()
+    assert out == ''
+    assert 'Converting' in err
+    with open(filename, 'rb') as f:
+        assert script._peek_json(f)[0] == datetime.datetime(2014, 7, 29, 15, 24, 35)
 
 
 def test_write_csv():
@@ -99,31 +412,264 @@ def test_write_csv():
     ]
 
 def test_peek_csv():
-    assert script._peek_csv(io.StringIO('')) == (script.EPOCH, [])
+    assert script._peek_csv(io.BytesIO(b'')) == (script.EPOCH, 0)
 
     # Wrong date format
     with pytest.raises(script.BrokenFile):
-        script._peek_csv(io.StringIO('2014-07-29 15:24:35;21.6;9010\n'))
+        script._peek_csv(io.BytesIO(b'2014-07-29 15:24:35;21.6;9010\n'))
 
-    CSV = '29.07.2014 15:23:03;21.6;9010\n' \
-        + '29.07.2014 15:24:35;21.52;5738\n'
-    last_dt, _ = script._peek_csv(io.StringIO(CSV))
+    CSV = b'29.07.2014 15:23:03;21.6;9010\n' \
+        + b'29.07.2014 15:24:35;21.52;5738\n'
+    last_dt, offset = script._peek_csv(io.BytesIO(CSV))
     assert last_dt == datetime.datetime(2014, 7, 29, 15, 24, 35)
+    assert offset == len(CSV)
+
+    # Trailing empty lines and partial last line are skipped
+    for tail in [b'\r\n\n', b'29.07.2014 15:25', b'\n29.07.2014 15:25', b'29.07.2014 15:25:00;21.']:
+        assert script._peek_csv(io.BytesIO(CSV + tail)) == (last_dt, len(CSV))
+
+    # Complete last record without line terminator is kept
+    assert script._peek_csv(io.BytesIO(CSV.rstrip())) == (last_dt, len(CSV) - 1)
+
+    # Reads backwards across chunk boundaries
+    old_chunk_size = script.TAIL_CHUNK_SIZE
+    script.TAIL_CHUNK_SIZE = 7
+    try:
+        assert script._peek_csv(io.BytesIO(CSV)) == (last_dt, len(CSV))
+    finally:
+        script.TAIL_CHUNK_SIZE = old_chunk_size
+
+
+def test_append_csv(tmpdir):
+    filename = str(tmpdir.join('ABBN.csv'))
+    with open(filename, 'w') as f:
+        f.write('29.07.2014 15:23:03;21.52;5738\n29.07.2014 15:2')
+
+    script.save_data(DATA, format='csv', mode='append', filename=filename)
+    with open(filename) as f:
+        assert script._read_csv(f).data == DATA.data
+
+    # Complete record without line terminator survives
+    with open(filename, 'w') as f:
+        f.write('29.07.2014 15:23:03;21.52;5738')
+    script.save_data(DATA, format='csv', mode='append', filename=filename)
+    with open(filename) as f:
+        assert script._read_csv(f).data == DATA.data
+
+
+def test_binary(tmpdir):
+    filename = str(tmpdir.join('ABBN.bin'))
+    script.save_data(DATA, format='bin', filename=filename)
+
+    with open(filename, 'rb') as f:
+        data = script._read_binary(f)
+    assert (data.symbol, data.isin) == (DATA.symbol, DATA.isin)
+    assert data.data == DATA.data
+    # Single chunk is memory-mapped, not copied
+    assert isinstance(data.times, memoryview)
+
+    # Empty file can't be mapped
+    tmpdir.join('empty.bin').write('')
+    with open(str(tmpdir.join('empty.bin')), 'rb') as f:
+        with pytest.raises(script.BrokenFile):
+            script._read_binary(f)
+
+
+def test_append_binary(tmpdir):
+    filename = str(tmpdir.join('ABBN.bin'))
+    script.save_data(DATA.slice(end=DATA.data[0][0]), format='bin', filename=filename)
+    # Leftover of interrupted write is overwritten
+    with open(filename, 'ab') as f:
+        f.write(b'\x05\0\0\0\0\0\0\0\x01')
+    with open(filename, 'rb') as f:
+        assert script._peek_binary(f)[0] == DATA.data[0][0]
+
+    script.save_data(DATA, format='bin', mode='append', filename=filename)
+    with open(filename, 'rb') as f:
+        assert script._read_binary(f).data == DATA.data
+
+    with pytest.raises(script.BrokenFile):
+        script._peek_binary(io.BytesIO(b'29.07.2014 15:23:03;21.52;5738\n'))
+
+
+@pytest.fixture(params=['gz', 'zst'])
+def compression(request):
+    if request.param == 'zst':
+        pytest.importorskip('zstandard')
+    return request.param
+
+
+@pytest.mark.parametrize('format', ['csv', 'json'])
+def test_append_compressed(tmpdir, compression, format):
+    filename = str(tmpdir.join('ABBN.%s.%s' % (format, compression)))
+    script.save_data(DATA.slice(end=DATA.data[0][0]), format=format, filename=filename)
+    codec = script._get_codec(compression)
+    with open(filename, 'rb') as f:
+        assert script._peek_compressed(f, codec)[0] == DATA.data[0][0]
+
+    script.save_data(DATA, format=format, mode='append', filename=filename)
+    script.save_data(DATA, format=format, mode='append', filename=filename)
+    data = script._read_data(filename)
+    assert data.data == DATA.data
+    assert script._filename_stem(filename) == 'ABBN'
+
+
+def test_append_gzip_legacy(tmpdir):
+    # Files compressed by gzip have no pointer, they are rewritten once
+    filename = str(tmpdir.join('ABBN.csv.gz'))
+    with gzip.open(filename, 'wt') as f:
+        f.write('29.07.2014 15:23:03;21.52;5738\n')
+
+    script.save_data(DATA, format='csv', mode='append', filename=filename)
+    with gzip.open(filename, 'rt') as f:
+        assert f.read() == '29.07.2014 15:23:03;21.52;5738\n29.07.2014 15:24:35;21.6;9010\n'
+
+
+def test_compress_option(tmpdir):
+    with tmpdir.as_cwd():
+        script.save_data(DATA, format='json', compress='gz')
+        with gzip.open('ABBN.json.gz', 'rt') as f:
+            assert json.load(f)['ticks'][0] == ["29.07.2014 15:23:03", 21.52, 5738]
+
+        # Given name gets codec extension
+        script.save_data(DATA, format='csv', filename='x.csv', compress='gz')
+        assert not os.path.exists('x.csv')
+        assert script._read_data('x.csv.gz').data == DATA.data
+
+        with open('broken.csv.gz', 'wb') as f:
+            f.write(b'29.07.2014 15:23:03;21.52;5738\n')
+        with pytest.raises(SystemExit):
+            script._read_data('broken.csv.gz')
+        with pytest.raises(SystemExit):
+            script.save_data(DATA, format='bin', compress='gz')
 
 
 # Database tests
 
+def test_stock_resolver(mock_db, fake_session):
+    mock_db.stocks.insert_one({'symbol': 'ATLN', 'isin': 'CH0043238366'})
+    assert script.find_stock('CH0043238366')['symbol'] == 'ATLN'
+
+    # Loaded once, so direct changes are not seen until invalidated
+    mock_db.stocks.insert_one({'symbol': 'UBSN', 'isin': 'CH0024899483'})
+    assert script.find_stock('UBSN') is None
+    assert [r['symbol'] for r in script.find_stocks(['ATLN', 'ATLN', 'CH0043238366'])] == ['ATLN']
+
+    script.do_add('ABBN')
+    assert script.find_stock('CH0012221716')['symbol'] == 'ABBN'
+    assert script.find_stock('UBSN')['isin'] == 'CH0024899483'
+
+    script.do_remove(['CH0012221716'])
+    assert script.find_stock('ABBN') is None
+
+
+def test_shared_client():
+    real = script._client
+    script._client = None
+    try:
+        # MongoClient connects lazily, so this doesn't need a server
+        assert script._get_client() is script._get_client()
+        assert script._get_db().client is script._get_client()
+    finally:
+        script._get_client().close()
+        script._client = real
+
+
 def test_db_save(mock_db):
     script.save_data_to_db(DATA)
-    assert list(mock_db.ticks.find(fields={'_id': False}, sort=[('time', pymongo.ASCENDING)])) == [
+    assert list(mock_db.ticks.find({}, {'_id': False}, sort=[('time', pymongo.ASCENDING)])) == [
         {'price': 21.52, 'isin': 'CH0012221716', 'symbol': 'ABBN', 'volume': 5738,
-         'time': datetime.datetime(2014, 7, 29, 15, 23, 3)},
+         'time': datetime.datetime(2014, 7, 29, 15, 23, 3), 'seq': 0},
         {'price': 21.6, 'isin': 'CH0012221716', 'symbol': 'ABBN', 'volume': 9010,
-        'time': datetime.datetime(2014, 7, 29, 15, 24, 35)}
+        'time': datetime.datetime(2014, 7, 29, 15, 24, 35), 'seq': 0}
     ]
 
+def test_db_save_idempotent(mock_db):
+    script.do_setup()
+    same_second = DATA.data[1][0]
+    data = script.MarketData(DATA.symbol, DATA.isin, DATA.data + [(same_second, 21.7, 100)])
+
+    assert script.save_data_to_db(DATA, batch_size=1) == 2
+    assert script.save_data_to_db(data, batch_size=1) == 1
+    assert script.save_data_to_db(data) == 0
+
+    ticks = mock_db.ticks.find({'time': same_second}, sort=[('seq', pymongo.ASCENDING)])
+    assert [(t['seq'], t['price']) for t in ticks] == [(0, 21.6), (1, 21.7)]
+
+
+@pytest.mark.parametrize('storage', ['ticks', 'buckets'])
+def test_db_save_merge(mock_db, storage, monkeypatch):
+    monkeypatch.setenv('SIX_SCRAPER_STORAGE', storage)
+    script.do_setup()
+    mock_db.stocks.insert_one({'symbol': 'ABBN', 'isin': 'CH0012221716'})
+    t = datetime.datetime(2014, 7, 29, 15, 23, 3)
+    data = script.MarketData('ABBN', 'CH0012221716', [
+        (t, 10.0, 100), (t, 12.0, 100), (t + datetime.timedelta(seconds=1), 11.0, 50),
+    ])
+    assert script.save_data_to_db(data) == 3
+
+    # Second trade is corrected, a late one comes in the last second and a new one after it
+    fixed = script.MarketData('ABBN', 'CH0012221716', [
+        (t, 10.0, 100), (t, 12.5, 100), (t + datetime.timedelta(seconds=1), 11.0, 50),
+        (t + datetime.timedelta(seconds=1), 11.5, 10), (t + datetime.timedelta(seconds=2), 11.0, 5),
+    ])
+    assert script.save_data_to_db(fixed) == 2
+    assert script.load_data_from_db('ABBN').data == fixed.data
+    assert mock_db.bars_1m.find_one()['high'] == 12.5
+
+    # Stored seconds missing from partial data are kept
+    assert script.save_data_to_db(fixed.slice(start=t + datetime.timedelta(seconds=1))) == 0
+    assert script.load_data_from_db('ABBN').data == fixed.data
+
+    day = datetime.datetime(2014, 7, 29)
+    digests = script.find_digests('ABBN')
+    assert digests[day][0] == 5
+    assert digests == {day: next(script._digests(fixed))[1:]}
+
+
+@pytest.mark.parametrize('storage', ['ticks', 'buckets'])
+def test_db_save_twice_digests(mock_db, storage, monkeypatch):
+    monkeypatch.setenv('SIX_SCRAPER_STORAGE', storage)
+    script.do_setup()
+    mock_db.stocks.insert_one({'symbol': DATA.symbol, 'isin': DATA.isin})
+    assert script.save_data_to_db(DATA) == 2
+
+    # Stale last time, e.g. from a concurrent writer, makes stored ticks go to insert again
+    stale = DATA.data[0][0] - datetime.timedelta(days=1)
+    assert script.save_data_to_db(DATA, last_time=stale) == 0
+    day = datetime.datetime(2014, 7, 29)
+    assert script.find_digests(DATA.symbol) == {day: next(script._digests(DATA))[1:]}
+    script.do_verify([DATA.symbol], deep=True)
+
+
+def test_verify(mock_db, capsys):
+    script.do_setup()
+    mock_db.stocks.insert_one({'symbol': 'ABBN', 'isin': 'CH0012221716'})
+    monday = datetime.datetime(2014, 7, 28, 10)
+    data = script.MarketData('ABBN', 'CH0012221716', [
+        (monday, 10.0, 100), (monday + datetime.timedelta(days=2), 11.0, 100),
+    ])
+    script.save_data_to_db(data)
+
+    # A gap on Tuesday is only warned about, as it could be a holiday
+    script.do_verify()
+    assert capsys.readouterr().err.splitlines() == ['ABBN 29.07.2014: no ticks']
+    script.do_verify(deep=True)
+
+    # Ticks changed behind ingestion are found by deep verification only
+    mock_db.ticks.delete_many({'time': monday})
+    with pytest.raises(SystemExit):
+        script.do_verify(['ABBN'], deep=True)
+    assert '28.07.2014: 1 ticks in digest, 0 stored' in capsys.readouterr().out
+
+    script.do_verify(['ABBN'], deep=True, repair=True)
+    script.do_verify(['ABBN'], deep=True)
+    script.do_rebuild_rollups(['ABBN'])
+    script.do_verify(['ABBN'])
+
+
 def test_db_load(mock_db):
-    mock_db.stocks.insert({'symbol': DATA.symbol, 'isin': DATA.isin})
+    mock_db.stocks.insert_one({'symbol': DATA.symbol, 'isin': DATA.isin})
     script.save_data_to_db(DATA)
 
     data = script.load_data_from_db(DATA.symbol)
@@ -137,3 +683,348 @@ def test_db_load(mock_db):
     data = script.load_data_from_db(DATA.symbol, to=DATA.data[0][0])
     assert data.data == DATA.data[:1]
 
+
+def test_update_not_modified(mock_db, fake_session):
+    script._do_update('ABBN')
+    assert mock_db.ticks.count_documents({}) == 2
+    assert mock_db.http_cache.find_one({'_id': 'ABBN'})['etag'] == '"v1"'
+
+    # Second request is conditional and is not parsed or saved
+    mock_db.ticks.delete_many({})
+    script._do_update('ABBN')
+    assert fake_session.requests[-1]['If-None-Match'] == '"v1"'
+    assert mock_db.ticks.count_documents({}) == 0
+
+
+def test_db_export_stream(mock_db):
+    stock = {'symbol': DATA.symbol, 'isin': DATA.isin}
+    mock_db.stocks.insert_one(dict(stock))
+    script.save_data_to_db(DATA)
+
+    data = script._export_data(stock, script.find_ticks(DATA.symbol))
+    assert isinstance(data, script.TickStream)
+    with capture() as c:
+        script._write_json(c.file, data)
+    assert json.loads(c.out)['ticks'] == [
+        ["29.07.2014 15:23:03", 21.52, 5738], ["29.07.2014 15:24:35", 21.6, 9010]
+    ]
+
+
+@pytest.fixture()
+def tick_cache(tmpdir, monkeypatch):
+    monkeypatch.setenv('SIX_SCRAPER_CACHE_DIR', str(tmpdir.join('cache')))
+    return script._get_cache()
+
+
+def test_tick_cache(mock_db, tick_cache):
+    mock_db.stocks.insert_one({'symbol': DATA.symbol, 'isin': DATA.isin})
+    script.save_data_to_db(DATA)
+
+    assert script.load_data_from_db(DATA.symbol).data == DATA.data
+    assert (tick_cache.hits, tick_cache.misses) == (0, 1)
+    assert os.listdir(os.path.join(tick_cache.path, 'ABBN')) == ['2014-07-29.2-%x.bin' % (
+        script.find_digests('ABBN')[datetime.datetime(2014, 7, 29)][1] & 0xffffffffffffffff)]
+
+    # Served from cache now, even if database changes behind its back
+    mock_db.ticks.delete_many({})
+    assert script.load_data_from_db(DATA.symbol, from_=DATA.data[1][0]).data == DATA.data[1:]
+    assert script.load_data_from_db(DATA.symbol, from_=DATA.data[0][0], to=DATA.data[0][0]).data \
+        == DATA.data[:1]
+    assert tick_cache.hits == 2
+
+    # Saving ticks into a cached day invalidates it
+    script.save_data_to_db(DATA)
+    assert os.listdir(os.path.join(tick_cache.path, 'ABBN')) == []
+
+    script.load_data_from_db(DATA.symbol)
+    script.do_remove([DATA.symbol], purge_data=True)
+    assert os.listdir(os.path.join(tick_cache.path, 'ABBN')) == []
+
+
+def test_tick_cache_other_writer(mock_db, tick_cache, monkeypatch):
+    mock_db.stocks.insert_one({'symbol': DATA.symbol, 'isin': DATA.isin})
+    script.save_data_to_db(DATA)
+    assert script.load_data_from_db(DATA.symbol).data == DATA.data
+
+    # Day changed by a process without cache is not served from stale file
+    monkeypatch.delenv('SIX_SCRAPER_CACHE_DIR')
+    late = (DATA.data[1][0] + datetime.timedelta(minutes=1), 21.7, 100)
+    script.save_data_to_db(script.MarketData(DATA.symbol, DATA.isin, DATA.data + [late]))
+    monkeypatch.setenv('SIX_SCRAPER_CACHE_DIR', tick_cache.path)
+    assert script.load_data_from_db(DATA.symbol).data == DATA.data + [late]
+    assert (tick_cache.hits, tick_cache.misses) == (0, 2)
+
+
+def test_tick_cache_eviction(tmpdir):
+    cache = script.TickCache(str(tmpdir), max_size=100)
+    for day in range(1, 4):
+        day = datetime.date(2014, 7, day)
+        cache.put('ABBN', day, script.MarketData('ABBN', None, [
+            (datetime.datetime.combine(day, datetime.time(9)), 21.5, 100),
+            (datetime.datetime.combine(day, datetime.time(10)), 21.6, 100),
+        ]))
+        os.utime(cache._filename('ABBN', day), (day.day, day.day))
+    cache.evict()
+    assert sorted(os.listdir(str(tmpdir.join('ABBN')))) == ['2014-07-03.0-0.bin']
+
+
+@pytest.fixture()
+def bucket_storage(monkeypatch):
+    monkeypatch.setenv('SIX_SCRAPER_STORAGE', 'buckets')
+
+
+def test_bucket_store(mock_db, bucket_storage):
+    mock_db.stocks.insert_one({'symbol': DATA.symbol, 'isin': DATA.isin})
+    next_day = datetime.datetime(2014, 7, 30, 9, 0, 0)
+    data = script.MarketData(DATA.symbol, DATA.isin, DATA.data + [(next_day, 22.0, 100)])
+
+    assert script.save_data_to_db(DATA) == 2
+    assert script.save_data_to_db(data) == 1
+    assert script.save_data_to_db(data) == 0
+
+    bucket = mock_db.tick_buckets.find_one({'day': datetime.datetime(2014, 7, 29)})
+    assert bucket['count'] == 2
+    assert bucket['times'] == [15 * 3600 + 23 * 60 + 3, 15 * 3600 + 24 * 60 + 35]
+    assert bucket['start'] == DATA.data[0][0]
+    assert bucket['end'] == DATA.data[1][0]
+
+    assert script.load_data_from_db(DATA.symbol).data == data.data
+    assert script.load_data_from_db(DATA.symbol, from_=DATA.data[1][0], to=next_day).data \
+        == data.data[1:]
+
+    assert script._get_store().remove([DATA.isin]) == 2
+    assert script.load_data_from_db(DATA.symbol).data == []
+
+
+def test_migrate(mock_db, monkeypatch):
+    mock_db.stocks.insert_one({'symbol': DATA.symbol, 'isin': DATA.isin})
+    script.save_data_to_db(DATA)
+
+    script.do_migrate('buckets')
+    assert mock_db.ticks.count_documents({}) == 0
+    monkeypatch.setenv('SIX_SCRAPER_STORAGE', 'buckets')
+    assert script.load_data_from_db(DATA.symbol).data == DATA.data
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_export_many(mock_db, tmpdir, workers):
+    ATLN = script.MarketData('ATLN', 'CH0010532478', [(DATA.data[0][0], 10.0, 12040)])
+    for data in [DATA, ATLN]:
+        mock_db.stocks.insert_one({'symbol': data.symbol, 'isin': data.isin})
+        script.save_data_to_db(data)
+
+    with tmpdir.as_cwd():
+        script.do_export(['ATLN', 'CH0012221716', 'XXXX'], workers=workers,
+                         options={'format': 'csv', 'mode': 'strict', 'filename': None})
+        with open('ABBN.csv') as f:
+            assert script._read_csv(f).data == DATA.data
+        with open('ATLN.csv') as f:
+            assert script._read_csv(f).data == ATLN.data
+
+
+def test_export_combined(mock_db, tmpdir):
+    ATLN = script.MarketData('ATLN', 'CH0010532478', [(DATA.data[0][0], 10.0, 12040)])
+    for data in [DATA, ATLN]:
+        mock_db.stocks.insert_one({'symbol': data.symbol, 'isin': data.isin})
+        script.save_data_to_db(data)
+
+    with tmpdir.as_cwd():
+        script.do_export(['ABBN', 'ATLN'], combined=True,
+                         options={'format': 'csv', 'mode': 'strict', 'filename': None})
+        with open('export.csv') as f:
+            assert f.read().splitlines() == [
+                'ABBN;29.07.2014 15:23:03;21.52;5738',
+                'ABBN;29.07.2014 15:24:35;21.6;9010',
+                'ATLN;29.07.2014 15:23:03;10.0;12040',
+            ]
+
+
+def test_export_resample(mock_db, tmpdir):
+    mock_db.stocks.insert_one({'symbol': DATA.symbol, 'isin': DATA.isin})
+    script.save_data_to_db(DATA)
+
+    with tmpdir.as_cwd():
+        script.do_export(['ABBN'], resample=60 * 60,
+                         options={'format': 'json', 'mode': 'strict', 'filename': None})
+        with open('ABBN.json') as f:
+            assert json.load(f)['bars'] == [
+                ['29.07.2014 15:00:00', 21.52, 21.6, 21.52, 21.6, 14748, 21.568874, 2]
+            ]
+
+
+def test_rollups(mock_db, tmpdir):
+    script.do_setup()
+    mock_db.stocks.insert_one({'symbol': 'ABBN', 'isin': 'CH0012221716'})
+    t = datetime.datetime(2014, 7, 29, 15, 23, 3)
+    data = script.MarketData('ABBN', 'CH0012221716', [(t, 10.0, 100), (t, 12.0, 100)])
+    script.save_data_to_db(data)
+    more = script.MarketData('ABBN', 'CH0012221716', [
+        (t, 10.0, 100), (t, 12.0, 100), (t, 9.0, 200),
+        (t + datetime.timedelta(days=1), 11.0, 50),
+    ])
+    script.save_data_to_db(more)
+
+    minutes = list(mock_db.bars_1m.find({}, {'_id': False}).sort('time', 1))
+    assert [(bar['time'], bar['low'], bar['count']) for bar in minutes] == [
+        (datetime.datetime(2014, 7, 29, 15, 23), 9.0, 3),
+        (datetime.datetime(2014, 7, 30, 15, 23), 11.0, 1),
+    ]
+    assert mock_db.bars_1d.count_documents({}) == 2
+
+    rebuilt = list(mock_db.bars_1m.find({}, {'_id': False}).sort('time', 1))
+    script.do_rebuild_rollups()
+    assert list(mock_db.bars_1m.find({}, {'_id': False}).sort('time', 1)) == rebuilt
+
+    with tmpdir.as_cwd():
+        script.do_export(['ABBN'], resample=2 * 24 * 60 * 60, rollups=True,
+                         options={'format': 'json', 'mode': 'strict', 'filename': None})
+        with open('ABBN.json') as f:
+            assert json.load(f)['bars'] == [
+                ['29.07.2014 00:00:00', 10.0, 12.0, 9.0, 11.0, 450, 10.111111, 4]
+            ]
+
+
+def test_rollups_historical(mock_db):
+    script.do_setup()
+    mock_db.stocks.insert_one({'symbol': 'ABBN', 'isin': 'CH0012221716'})
+    t = datetime.datetime(2014, 7, 29, 15, 23, 3)
+    later = t + datetime.timedelta(days=1)
+    script.save_data_to_db(script.MarketData('ABBN', 'CH0012221716', [(later, 11.0, 50)]))
+    # Later bars are marked to see if they get rewritten
+    for collection in ['bars_1m', 'bars_1d']:
+        mock_db[collection].update_many({}, {'$set': {'marked': True}})
+
+    # Loading older slice only touches its bars
+    script.save_data_to_db(script.MarketData('ABBN', 'CH0012221716', [(t, 10.0, 100)]))
+    for collection in ['bars_1m', 'bars_1d']:
+        bars = list(mock_db[collection].find({}, {'_id': False}).sort('time', 1))
+        assert [(bar['close'], bar.get('marked')) for bar in bars] == [(10.0, None), (11.0, True)]
+
+
+def test_rollups_unsorted_load(mock_db, tmpdir, capsys):
+    script.do_setup()
+    mock_db.stocks.insert_one({'symbol': 'ABBN', 'isin': 'CH0012221716'})
+    filename = str(tmpdir.join('ABBN.csv'))
+    with open(filename, 'w') as f:
+        f.write('30.07.2014 09:00:00;22.0;100\n'
+                '29.07.2014 15:24:35;21.6;9010\n'
+                '29.07.2014 15:23:03;21.52;5738\n')
+
+    script.save_data_to_db(script.load_data(filename))
+    bars = list(mock_db.bars_1d.find({}, {'_id': False}).sort('time', 1))
+    assert [(bar['count'], bar['close']) for bar in bars] == [(2, 21.6), (1, 22.0)]
+    script.do_verify()
+
+
+def test_pickle_mapped(tmpdir):
+    filename = str(tmpdir.join('ABBN.bin'))
+    script.save_data(DATA, format='bin', filename=filename)
+    with open(filename, 'rb') as f:
+        data = script._read_binary(f)
+    data = pickle.loads(pickle.dumps(data))
+    assert (data.symbol, data.isin, data.data) == (DATA.symbol, DATA.isin, DATA.data)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_load_many(mock_db, tmpdir, capsys, workers):
+    mock_db.stocks.insert_one({'symbol': 'ABBN', 'isin': 'CH0012221716'})
+    mock_db.stocks.insert_one({'symbol': 'ATLN', 'isin': 'CH0043238366'})
+    tmpdir.mkdir('2014')
+    with tmpdir.as_cwd():
+        script.save_data(DATA, format='csv', filename='2014/ABBN.csv')
+        atln = script.MarketData('ATLN', 'CH0043238366', DATA.data)
+        script.save_data(atln, format='json', filename='2014/ATLN.json')
+        script.save_data(DATA, format='csv', filename='ZZZZ.csv')
+        tmpdir.join('2014', 'notes.txt').write('')
+
+        with pytest.raises(SystemExit):
+            script.do_load(['2014', '*.csv'], workers=workers,
+                           options={'format': None, 'filename': None})
+
+    out, err = capsys.readouterr()
+    assert '2014/ABBN.csv: Inserted 2 ticks' in out
+    assert "Can't guess stock for ZZZZ.csv" in err
+    assert 'Failed to load 1 of 3 files.' in err
+    assert mock_db.ticks.count_documents({'symbol': 'ABBN'}) == 2
+    assert mock_db.ticks.count_documents({'symbol': 'ATLN'}) == 2
+
+
+def test_load_as(mock_db, tmpdir, capsys, monkeypatch):
+    mock_db.stocks.insert_one({'symbol': 'ABBN', 'isin': 'CH0012221716'})
+    with tmpdir.as_cwd():
+        script.save_data(DATA, format='csv', filename='ticks.csv')
+        monkeypatch.setattr('sys.argv', ['six-scraper', 'load', 'ticks.csv', '--as', 'CH0012221716'])
+        script.main()
+
+    assert 'Inserted 2 ticks' in capsys.readouterr().out
+    assert mock_db.ticks.count_documents({'symbol': 'ABBN'}) == 2
+
+
+STATS_DATA = script.MarketData('ABBN', 'CH0012221716', [
+    (datetime.datetime(2014, 7, 29, 15, 23, 3), 10.0, 100),
+    (datetime.datetime(2014, 7, 29, 15, 40, 0), 12.0, 100),
+    (datetime.datetime(2014, 7, 29, 16, 5, 0), 11.0, 50),
+])
+
+
+@pytest.fixture(params=['python', 'numpy'])
+def stats_impl(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(script, 'np', None)
+
+
+def test_tick_stats(stats_impl):
+    assert list(script.tick_stats(STATS_DATA, 60 * 60)) == [
+        (datetime.datetime(2014, 7, 29, 15), 2, 200, 2200.0, 11.0, 0.18232156),
+        (datetime.datetime(2014, 7, 29, 16), 1, 50, 550.0, 11.0, 0.0),
+    ]
+    assert list(script.tick_stats(STATS_DATA, 24 * 60 * 60)) == [
+        (datetime.datetime(2014, 7, 29), 3, 250, 2750.0, 11.0, 0.20202012),
+    ]
+    assert list(script.tick_stats(script.MarketData('ABBN', None), 60)) == []
+
+
+def test_tick_stats_implementations_agree():
+    np = pytest.importorskip('numpy')
+    t = datetime.datetime(2014, 7, 29, 15, 23, 3)
+    data = script.MarketData('ABBN', None, [
+        (t, 10.0, 100),
+        (t + datetime.timedelta(seconds=1), 0.0, 10),
+        (t + datetime.timedelta(minutes=1), 12.0, 100),
+        (t + datetime.timedelta(minutes=2), -1.0, 10),
+        (t + datetime.timedelta(hours=1), 0.0, 10),
+        (t + datetime.timedelta(hours=1, minutes=1), 11.0, 50),
+    ])
+    # Non-positive prices are skipped by both
+    stats = list(script._tick_stats(data, 60 * 60))
+    assert stats == [
+        (1406646000, 2, 200, 2200.0, pytest.approx(math.log(1.2) ** 2)),
+        (1406649600, 1, 50, 550.0, 0.0),
+    ]
+    assert np.allclose(list(script._tick_stats_numpy(data, 60 * 60)), stats)
+
+
+@pytest.mark.parametrize('storage', ['ticks', 'buckets'])
+def test_stats(mock_db, tmpdir, tick_cache, stats_impl, storage, monkeypatch):
+    monkeypatch.setenv('SIX_SCRAPER_STORAGE', storage)
+    mock_db.stocks.insert_many([{'symbol': 'ABBN', 'isin': 'CH0012221716'},
+                                {'symbol': 'NESN', 'isin': 'CH0038863350'}])
+    script.save_data_to_db(STATS_DATA)
+
+    with tmpdir.as_cwd():
+        # All stocks by default, from cache on second run
+        for _ in range(2):
+            script.do_stats(by='hour', options={'format': 'json', 'mode': 'overwrite', 'filename': None})
+            with open('stats.json') as f:
+                assert json.load(f)['stats'] == [
+                    ['ABBN', '29.07.2014 15:00:00', 2, 200, 2200.0, 11.0, 0.18232156],
+                    ['ABBN', '29.07.2014 16:00:00', 1, 50, 550.0, 11.0, 0.0],
+                ]
+        assert tick_cache.hits
+
+        script.do_stats(['ABBN'], from_=datetime.datetime(2014, 7, 29, 15, 30),
+                        options={'format': 'csv', 'mode': 'strict', 'filename': 'abbn.csv'})
+        with open('abbn.csv') as f:
+            assert f.read() == 'ABBN;29.07.2014 00:00:00;2;150;1750.0;11.666667;0.08701138\n'